@@ -0,0 +1,272 @@
+import os
+
+import numpy as np
+from paddle import inference
+
+
+BACKEND_DYGRAPH = "dygraph"
+""" runs the dynamic graph model via CustomEngine. """
+
+BACKEND_INFERENCE = "inference"
+""" runs the exported static graph model via the paddle.inference predictor. """
+
+BACKEND_ONNX = "onnx"
+""" runs the model converted via paddle2onnx through ONNX Runtime. """
+
+BACKENDS = [BACKEND_DYGRAPH, BACKEND_INFERENCE, BACKEND_ONNX]
+""" the available backends. """
+
+PRECISION_FP32 = "fp32"
+""" full precision model. """
+
+PRECISION_INT8 = "int8"
+""" post-training quantized model (inference backend, CPU). """
+
+PRECISIONS = [PRECISION_FP32, PRECISION_INT8]
+""" the available precisions. """
+
+INT8_SUFFIX = "_int8"
+""" the suffix for the path prefix of quantized models. """
+
+
+def gpu_id(device: str) -> int:
+    """
+    Returns the ID of the GPU, e.g., 1 for gpu:1 (0 for just gpu).
+
+    :param device: the device, e.g., gpu or gpu:1
+    :type device: str
+    :return: the ID of the GPU
+    :rtype: int
+    """
+    if ":" not in device:
+        return 0
+    try:
+        return int(device.split(":", 1)[1])
+    except ValueError:
+        raise Exception("Invalid device: %s" % device)
+
+
+def check_backend(backend: str, precision: str, device: str):
+    """
+    Checks whether the combination of backend, precision and device is supported, raises an exception otherwise.
+
+    :param backend: the backend to run the model with, e.g., dygraph, inference or onnx
+    :type backend: str
+    :param precision: the precision of the model, e.g., fp32 or int8
+    :type precision: str
+    :param device: the device to use, e.g., gpu, gpu:1 or cpu
+    :type device: str
+    """
+    if backend not in BACKENDS:
+        raise Exception("Unsupported backend: %s" % backend)
+    if precision not in PRECISIONS:
+        raise Exception("Unsupported precision: %s" % precision)
+    if (precision != PRECISION_FP32) and (backend != BACKEND_INFERENCE):
+        raise Exception("Precision %s requires backend: %s" % (precision, BACKEND_INFERENCE))
+    if device.startswith("gpu"):
+        gpu_id(device)
+        if precision == PRECISION_INT8:
+            raise Exception("INT8 models are only supported on CPU, use --device cpu (device: %s)!" % device)
+
+
+def set_num_threads(num_threads: int):
+    """
+    Sets the number of threads of the math libraries (OpenMP/MKL) that the dygraph model runs on,
+    e.g., in a forked worker process, via core.set_num_threads. The OMP_NUM_THREADS/MKL_NUM_THREADS
+    environment variables are not set, as they only get read when paddle is loaded.
+
+    :param num_threads: the number of threads
+    :type num_threads: int
+    """
+    from paddle.base import core
+    core.set_num_threads(num_threads)
+
+
+def model_prefix(model_path: str) -> str:
+    """
+    Returns the path prefix of the model, i.e., without the .pdparams extension.
+
+    :param model_path: the path to the trained model (.pdparams file)
+    :type model_path: str
+    :return: the path prefix
+    :rtype: str
+    """
+    if model_path.endswith(".pdparams"):
+        return model_path[:-len(".pdparams")]
+    return model_path
+
+
+def is_outdated(model_path: str, path: str) -> bool:
+    """
+    Checks whether the derived model file is missing or older than the trained model.
+
+    :param model_path: the path to the trained model (.pdparams file)
+    :type model_path: str
+    :param path: the path of the derived file to check
+    :type path: str
+    :return: True if the derived file needs (re-)generating
+    :rtype: bool
+    """
+    if not os.path.exists(path):
+        return True
+    params = model_prefix(model_path) + ".pdparams"
+    if os.path.exists(params):
+        return os.path.getmtime(params) > os.path.getmtime(path)
+    return False
+
+
+def export_static(engine, model_path: str) -> str:
+    """
+    Exports the model as static graph next to the .pdparams file, unless already present and up-to-date.
+
+    :param engine: the engine with the loaded model
+    :type engine: CustomEngine
+    :param model_path: the path to the trained model (.pdparams file)
+    :type model_path: str
+    :return: the path prefix of the static model (.pdmodel/.pdiparams)
+    :rtype: str
+    """
+    prefix = model_prefix(model_path)
+    if is_outdated(model_path, prefix + ".pdmodel"):
+        engine.export_static(prefix)
+    return prefix
+
+
+def export_onnx(engine, model_path: str) -> str:
+    """
+    Converts the model to ONNX next to the .pdparams file, unless already present and up-to-date.
+
+    :param engine: the engine with the loaded model
+    :type engine: CustomEngine
+    :param model_path: the path to the trained model (.pdparams file)
+    :type model_path: str
+    :return: the path of the .onnx file
+    :rtype: str
+    """
+    prefix = model_prefix(model_path)
+    if is_outdated(model_path, prefix + ".onnx"):
+        engine.export_onnx(prefix)
+    return prefix + ".onnx"
+
+
+class PaddleInferencePredictor(object):
+    """
+    Runs a static graph model through the paddle.inference predictor, with IR optimization,
+    oneDNN (CPU only) and memory optimization turned on.
+    """
+
+    def __init__(self, prefix: str, device: str = "cpu", num_threads: int = None, precision: str = PRECISION_FP32):
+        """
+        Initializes the predictor. The actual paddle.inference predictor gets created on first use.
+
+        :param prefix: the path prefix of the static model (.pdmodel/.pdiparams)
+        :type prefix: str
+        :param device: the device to use, e.g., gpu or cpu
+        :type device: str
+        :param num_threads: the number of CPU math library threads, uses all cores if None
+        :type num_threads: int
+        :param precision: the precision of the model, e.g., fp32 or int8 (quantized model, CPU only)
+        :type precision: str
+        """
+        self.prefix = prefix
+        self.device = device
+        self.num_threads = num_threads
+        self.precision = precision
+        self._predictor = None
+        self._input = None
+        self._output = None
+
+    def _configure(self):
+        """
+        Creates the configuration for the predictor.
+
+        :return: the configuration
+        :rtype: paddle.inference.Config
+        """
+        config = inference.Config(self.prefix + ".pdmodel", self.prefix + ".pdiparams")
+        if self.device.startswith("gpu"):
+            if self.precision == PRECISION_INT8:
+                raise Exception("INT8 models are only supported on CPU!")
+            config.enable_use_gpu(256, gpu_id(self.device))
+        else:
+            config.disable_gpu()
+            config.enable_mkldnn()
+            if self.precision == PRECISION_INT8:
+                config.enable_mkldnn_int8()
+            # variable batch sizes
+            config.set_mkldnn_cache_capacity(10)
+            config.set_cpu_math_library_num_threads(self.num_threads if self.num_threads is not None else os.cpu_count())
+        config.switch_ir_optim(True)
+        config.enable_memory_optim()
+        config.disable_glog_info()
+        config.switch_use_feed_fetch_ops(False)
+        return config
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Runs the model on the batch.
+
+        :param batch: the preprocessed images (NCHW, float32)
+        :type batch: np.ndarray
+        :return: the logits
+        :rtype: np.ndarray
+        """
+        if self._predictor is None:
+            self._predictor = inference.create_predictor(self._configure())
+            self._input = self._predictor.get_input_handle(self._predictor.get_input_names()[0])
+            self._output = self._predictor.get_output_handle(self._predictor.get_output_names()[0])
+        self._input.reshape(batch.shape)
+        self._input.copy_from_cpu(np.ascontiguousarray(batch))
+        self._predictor.run()
+        return self._output.copy_to_cpu()
+
+
+class OnnxRuntimePredictor(object):
+    """
+    Runs an ONNX model through ONNX Runtime.
+    """
+
+    def __init__(self, path: str, device: str = "cpu", intra_op_threads: int = None, inter_op_threads: int = None):
+        """
+        Initializes the predictor. The actual inference session gets created on first use.
+
+        :param path: the path to the .onnx file
+        :type path: str
+        :param device: the device to use, e.g., gpu or cpu
+        :type device: str
+        :param intra_op_threads: the number of threads to use within an operator, ONNX Runtime default if None
+        :type intra_op_threads: int
+        :param inter_op_threads: the number of threads to use for running operators in parallel, ONNX Runtime default if None
+        :type inter_op_threads: int
+        """
+        self.path = path
+        self.device = device
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self._session = None
+        self._input = None
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Runs the model on the batch.
+
+        :param batch: the preprocessed images (NCHW, float32)
+        :type batch: np.ndarray
+        :return: the logits
+        :rtype: np.ndarray
+        """
+        if self._session is None:
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.intra_op_threads is not None:
+                options.intra_op_num_threads = self.intra_op_threads
+            if self.inter_op_threads is not None:
+                options.inter_op_num_threads = self.inter_op_threads
+                options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            providers = ["CPUExecutionProvider"]
+            if self.device.startswith("gpu") and ("CUDAExecutionProvider" in ort.get_available_providers()):
+                providers.insert(0, ("CUDAExecutionProvider", {"device_id": gpu_id(self.device)}))
+            self._session = ort.InferenceSession(self.path, sess_options=options, providers=providers)
+            self._input = self._session.get_inputs()[0].name
+        return self._session.run(None, {self._input: np.ascontiguousarray(batch)})[0]
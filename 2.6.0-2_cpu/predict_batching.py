@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, List
+
+from rdh import log
+
+
+OVERFLOW_BLOCK = "block"
+""" waits for space in the queue. """
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+""" drops the oldest item in the queue to make space. """
+
+OVERFLOW_DROP_NEWEST = "drop_newest"
+""" drops the new item. """
+
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST]
+""" the available policies for full queues. """
+
+
+def put_item(items, item, overflow: str = OVERFLOW_BLOCK) -> int:
+    """
+    Adds the item to the (bounded) queue, applying the overflow policy if the queue is full.
+
+    :param items: the queue to add the item to (queue.Queue or multiprocessing.Queue)
+    :param item: the item to add
+    :param overflow: the overflow policy (block/drop_oldest/drop_newest)
+    :type overflow: str
+    :return: the number of dropped items
+    :rtype: int
+    """
+    if overflow == OVERFLOW_BLOCK:
+        items.put(item)
+        return 0
+    try:
+        items.put_nowait(item)
+        return 0
+    except queue.Full:
+        if overflow == OVERFLOW_DROP_NEWEST:
+            return 1
+    try:
+        items.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        items.put_nowait(item)
+        return 1
+    except queue.Full:
+        return 2
+
+
+class MicroBatcher(object):
+    """
+    Collects incoming items in a queue and hands them on in batches to the processing function,
+    once either the maximum batch size has been reached or the maximum wait time (since the
+    first item of the batch arrived) has passed.
+    """
+
+    def __init__(self, process_batch: Callable[[List], None], max_batch_size: int, max_wait_ms: float, items=None,
+                 max_queue_size: int = 0, overflow: str = OVERFLOW_BLOCK):
+        """
+        Initializes the batcher.
+
+        :param process_batch: the function to call with the list of collected items
+        :param max_batch_size: the maximum number of items per batch
+        :type max_batch_size: int
+        :param max_wait_ms: the maximum time in milliseconds to wait for further items before processing the batch
+        :type max_wait_ms: float
+        :param items: the queue to collect the items from (e.g., a multiprocessing queue), creates one if None
+        :param max_queue_size: the maximum number of items in the queue created by the batcher, unbounded if <= 0
+        :type max_queue_size: int
+        :param overflow: the policy for adding items to a full queue (block/drop_oldest/drop_newest)
+        :type overflow: str
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+        self.queue = queue.Queue(max(0, max_queue_size)) if items is None else items
+        self.overflow = overflow
+        self.dropped = 0
+        self.stopped = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the thread that processes the batches.
+        """
+        self.stopped = False
+        self._thread = threading.Thread(target=self.run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the processing thread, after processing the items that were already queued.
+        """
+        self.stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def put(self, item):
+        """
+        Adds the item to the queue.
+
+        :param item: the item to add
+        """
+        self.dropped += put_item(self.queue, item, self.overflow)
+
+    def next_batch(self) -> List:
+        """
+        Collects the next batch, returns an empty list if no item arrived within 100ms.
+
+        :return: the collected items
+        :rtype: list
+        """
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        """
+        Processes the batches in the current thread until stopped.
+        """
+        while not self.stopped or not self.queue.empty():
+            batch = self.next_batch()
+            if len(batch) == 0:
+                continue
+            try:
+                self.process_batch(batch)
+            except Exception:
+                log("micro-batcher - failed to process batch of %d item(s): %s" % (len(batch), traceback.format_exc()))
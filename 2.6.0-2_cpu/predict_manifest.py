@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterable
+
+
+STATUS_DONE = 1
+""" the prediction of the item has been written. """
+
+STATUS_FAILED = 2
+""" the item failed to process. """
+
+
+def in_shard(key: str, shard_index: int, num_shards: int) -> bool:
+    """
+    Checks whether the item belongs to the shard, using the CRC32 of the key (stable across processes and hosts).
+
+    :param key: the key of the item
+    :type key: str
+    :param shard_index: the 0-based index of the shard
+    :type shard_index: int
+    :param num_shards: the number of shards
+    :type num_shards: int
+    :return: True if part of the shard
+    :rtype: bool
+    """
+    if num_shards <= 1:
+        return True
+    return zlib.crc32(key.encode("utf-8")) % num_shards == shard_index
+
+
+class Manifest(object):
+    """
+    Records the processed items per model fingerprint in a SQLite database, so that interrupted runs can skip
+    the items that were completed already (keys only, no hashing of the content). Several processes can share
+    the database, e.g., when processing different shards.
+    """
+
+    def __init__(self, path: str, fingerprint: str, timeout: float = 60.0):
+        """
+        Opens/creates the manifest.
+
+        :param path: the SQLite database file
+        :type path: str
+        :param fingerprint: the fingerprint of the model, items processed with other models do not count as processed
+        :type fingerprint: str
+        :param timeout: the time in seconds to wait for locks held by other processes
+        :type timeout: float
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "fingerprint TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "status INTEGER NOT NULL, "
+            "timestamp REAL NOT NULL, "
+            "PRIMARY KEY (fingerprint, key)) WITHOUT ROWID")
+        self._conn.commit()
+
+    def status(self, key: str):
+        """
+        Returns the status of the item.
+
+        :param key: the key of the item
+        :type key: str
+        :return: the status (STATUS_DONE/STATUS_FAILED), None if not processed yet
+        :rtype: int
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM items WHERE fingerprint = ? AND key = ?",
+                                     (self.fingerprint, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def is_processed(self, key: str, retry_failed: bool = False) -> bool:
+        """
+        Checks whether the item has been processed already, counting the skipped items.
+
+        :param key: the key of the item
+        :type key: str
+        :param retry_failed: whether items that failed do not count as processed
+        :type retry_failed: bool
+        :return: True if processed
+        :rtype: bool
+        """
+        status = self.status(key)
+        result = (status == STATUS_DONE) or ((status == STATUS_FAILED) and not retry_failed)
+        if result:
+            self.skipped += 1
+        return result
+
+    def mark(self, keys: Iterable[str], status: int = STATUS_DONE):
+        """
+        Records the items as processed.
+
+        :param keys: the keys of the items
+        :type keys: iterable
+        :param status: the status of the items (STATUS_DONE/STATUS_FAILED)
+        :type status: int
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO items (fingerprint, key, status, timestamp) VALUES (?, ?, ?, ?)",
+                                   [(self.fingerprint, key, status, now) for key in keys])
+            self._conn.commit()
+
+    def counts(self) -> dict:
+        """
+        Returns the number of items per status for the fingerprint.
+
+        :return: the counts (status -> count)
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM items WHERE fingerprint = ? GROUP BY status",
+                                      (self.fingerprint,)).fetchall()
+        return dict(rows)
+
+    def stats(self) -> str:
+        """
+        Returns the statistics of the manifest.
+
+        :return: the statistics
+        :rtype: str
+        """
+        counts = self.counts()
+        return "done: %d, failed: %d, skipped: %d" % (counts.get(STATUS_DONE, 0), counts.get(STATUS_FAILED, 0), self.skipped)
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self._lock:
+            self._conn.close()
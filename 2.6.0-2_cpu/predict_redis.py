@@ -1,8 +1,249 @@
 from datetime import datetime
+from functools import partial
+import os
 import traceback
 
-from rdh import Container, MessageContainer, create_parser, configure_redis, run_harness, log
-from predict_common import prediction_to_data, load_model
+import orjson
+from rdh import Container, create_parser, configure_redis, run_harness, log
+from ppcls.engine.custom_engine import error_result, is_error
+from predict_async import AsyncReceiver
+from predict_backends import BACKENDS, BACKEND_DYGRAPH, PRECISIONS, PRECISION_FP32, set_num_threads
+from predict_batching import MicroBatcher, OVERFLOW_POLICIES, OVERFLOW_BLOCK
+from predict_cache import PredictionCache, CachedEngine
+from predict_common import prediction_to_data, load_model, report_stats, on_shutdown, run_shutdown
+from predict_prefork import WorkerPool
+from predict_shedding import LoadShedder, EXPIRED_POLICIES, EXPIRED_DROP, EXPIRED_FAIL, DEADLINE_EXCEEDED
+from predict_shm import SharedImage, is_reference
+from predict_protocol import MESSAGE_FORMATS, MESSAGE_FORMAT_SINGLE, decode_images, predictions_to_data
+from predict_streams import StreamConsumer, default_consumer
+
+
+def infer_images(config, imgs):
+    """
+    Runs inference on the images, opening the images referenced in shared memory/files first (if enabled).
+
+    :param config: the configuration container with the engine
+    :type config: Container
+    :param imgs: the images (or references) to run inference on
+    :type imgs: list
+    :return: the predictions, aligned with the images
+    :rtype: list
+    """
+    if not config.shared_memory:
+        return config.engine.infer_raw(imgs)
+    preds = [None] * len(imgs)
+    shared = []
+    valid = []
+    for i, img in enumerate(imgs):
+        if is_reference(img):
+            try:
+                shared.append(SharedImage(img, file_dir=config.shm_dir, shm_prefix=config.shm_prefix))
+                valid.append((i, shared[-1].data))
+            except Exception as e:
+                preds[i] = error_result("Failed to open shared image: %s" % str(e))
+        else:
+            valid.append((i, img))
+    try:
+        for (i, _), pred in zip(valid, config.engine.infer_raw([x[1] for x in valid])):
+            preds[i] = pred
+    finally:
+        valid = None
+        for image in shared:
+            try:
+                image.close()
+            except Exception:
+                log("infer_images - failed to close shared image %s: %s" % (image.name, traceback.format_exc()))
+    return preds
+
+
+def infer_messages(config, messages, received=None):
+    """
+    Runs a single inference on the images of all the messages and generates the output per message.
+    Expired messages (if load shedding is enabled) get skipped before decoding.
+
+    :param config: the configuration container with the engine and the message format
+    :type config: Container
+    :param messages: the messages to process
+    :type messages: list
+    :param received: the times the messages were received (aligned with the messages), None if just now
+    :type received: list
+    :return: the list of outputs (JSON bytes, error result or None if expired and to be dropped) aligned with the messages, the images and their predictions; expired messages to be failed get the DEADLINE_EXCEEDED error
+    :rtype: tuple
+    """
+    outputs = [None] * len(messages)
+    valid = []
+    for i, message in enumerate(messages):
+        if config.shedder is not None:
+            try:
+                message, expired = config.shedder.unwrap(message, received[i] if received is not None else None)
+            except Exception as e:
+                outputs[i] = error_result("Failed to decode message: %s" % str(e))
+                continue
+            if expired:
+                if config.shedder.expired == EXPIRED_FAIL:
+                    outputs[i] = error_result(DEADLINE_EXCEEDED)
+                continue
+        valid.append((i, message))
+
+    if config.message_format == MESSAGE_FORMAT_SINGLE:
+        imgs = [x[1] for x in valid]
+        preds = infer_images(config, imgs)
+        for (i, _), pred in zip(valid, preds):
+            outputs[i] = pred if is_error(pred) else prediction_to_data(pred, **config.output_options)
+        return outputs, imgs, preds
+
+    requests = []
+    imgs = []
+    for i, message in valid:
+        try:
+            request_id, request_imgs = decode_images(message)
+            requests.append((i, request_id, len(request_imgs)))
+            imgs.extend(request_imgs)
+        except Exception as e:
+            requests.append((i, None, str(e)))
+    preds = infer_images(config, imgs)
+    offset = 0
+    for i, request_id, count in requests:
+        if request_id is None:
+            outputs[i] = error_result("Failed to decode message: %s" % count)
+            continue
+        outputs[i] = predictions_to_data(request_id, preds[offset:offset + count], **config.output_options)
+        offset += count
+    return outputs, imgs, preds
+
+
+def load_stats(config) -> str:
+    """
+    Returns the load shedding counters: processed and expired messages, messages dropped due to a full queue.
+
+    :param config: the configuration container
+    :type config: Container
+    :return: the counters
+    :rtype: str
+    """
+    result = []
+    if config.shedder is not None:
+        result.append(config.shedder.stats())
+    if config.batcher is not None:
+        result.append("dropped: %d" % config.batcher.dropped)
+    if config.receiver is not None:
+        result.append("dropped: %d" % config.receiver.dropped)
+    return ", ".join(result)
+
+
+def predict_batch(config, items):
+    """
+    Runs a single inference on the batch of images collected by the micro-batcher/receiver and generates the outputs.
+
+    :param config: the configuration container with the engine
+    :type config: Container
+    :param items: the list of (image data, time received) tuples
+    :type items: list
+    :return: the outputs to publish
+    :rtype: list
+    """
+    start_time = datetime.now()
+
+    result = []
+    outputs, imgs, preds = infer_messages(config, [x[0] for x in items], [x[1] for x in items])
+    for output in outputs:
+        if output is None:
+            continue
+        if is_error(output):
+            if output["error"] == DEADLINE_EXCEEDED:
+                result.append(orjson.dumps(output))
+            else:
+                log("predict_batch - %s" % output["error"])
+            continue
+        result.append(output)
+    if config.reduced_decode_check:
+        log("predict_batch - reduced decode check: %s" % str(config.engine.check_reduced_decode(imgs, preds)))
+
+    if config.verbose:
+        if (config.shedder is not None) or (config.batcher is not None) or (config.receiver is not None):
+            log("predict_batch - load: %s" % load_stats(config))
+        if config.engine.num_workers > 0:
+            log("predict_batch - pipeline stall: %d ms" % int(config.engine.last_stall_time * 1000))
+        if isinstance(config.engine, CachedEngine):
+            log("predict_batch - cache: %s" % config.engine.cache.stats())
+        end_time = datetime.now()
+        batch_time = int((end_time - start_time).total_seconds() * 1000)
+        max_time = int((end_time - min(x[1] for x in items)).total_seconds() * 1000)
+        log("predict_batch - finished processing batch of %d image(s): %d ms (max latency: %d ms)" % (len(items), batch_time, max_time))
+    return result
+
+
+def process_batch(params, items):
+    """
+    Processes the batch of images collected by the micro-batcher, running a single inference on
+    all of them and forwarding the predictions.
+
+    :param params: the parameter container with the redis connection and channels
+    :type params: ParameterContainer
+    :param items: the list of (image data, time received) tuples
+    :type items: list
+    """
+    outputs = predict_batch(params.config, items)
+    for output in outputs:
+        params.redis.publish(params.channel_out, output)
+    if params.config.verbose:
+        log("process_batch - %d prediction(s) published: %s" % (len(outputs), params.channel_out))
+
+
+def process_entries(config, messages):
+    """
+    Processes the batch of messages read from the stream, running a single inference on all of their images.
+
+    :param config: the configuration container with the engine
+    :type config: Container
+    :param messages: the list of messages
+    :type messages: list
+    :return: the list of fields for the output entries, None for expired entries that only get acknowledged
+    :rtype: list
+    """
+    start_time = datetime.now()
+    result = []
+    outputs, imgs, preds = infer_messages(config, messages)
+    for output in outputs:
+        if output is None:
+            result.append(None)
+        elif is_error(output):
+            if output["error"] != DEADLINE_EXCEEDED:
+                log("process_entries - %s" % output["error"])
+            result.append({"error": output["error"]})
+        else:
+            result.append({"data": output})
+    if config.reduced_decode_check:
+        log("process_entries - reduced decode check: %s" % str(config.engine.check_reduced_decode(imgs, preds)))
+
+    if config.verbose:
+        if config.engine.num_workers > 0:
+            log("process_entries - pipeline stall: %d ms" % int(config.engine.last_stall_time * 1000))
+        if isinstance(config.engine, CachedEngine):
+            log("process_entries - cache: %s" % config.engine.cache.stats())
+        batch_time = int((datetime.now() - start_time).total_seconds() * 1000)
+        log("process_entries - finished processing batch of %d message(s): %d ms" % (len(messages), batch_time))
+    return result
+
+
+def run_consumer(parsed, config, consumer: str):
+    """
+    Processes the images from the input stream as part of the consumer group.
+
+    :param parsed: the parsed command-line arguments
+    :type parsed: argparse.Namespace
+    :param config: the configuration container with the engine
+    :type config: Container
+    :param consumer: the name of the consumer
+    :type consumer: str
+    """
+    params = configure_redis(parsed, config=config)
+    batch_size = parsed.max_batch_size
+    if batch_size is None:
+        batch_size = config.engine.config["Infer"]["batch_size"]
+    StreamConsumer(params.redis, params.channel_in, params.channel_out, parsed.group, consumer,
+                   batch_size=batch_size, block_ms=parsed.block_ms, claim_idle_ms=parsed.claim_idle_ms,
+                   maxlen=parsed.stream_maxlen, max_deliveries=parsed.max_deliveries).run(partial(process_entries, config))
 
 
 def process_image(msg_cont):
@@ -17,13 +258,29 @@ def process_image(msg_cont):
     try:
         start_time = datetime.now()
 
+        if config.batcher is not None:
+            config.batcher.put((msg_cont.message['data'], start_time))
+            return
+        if (config.message_format != MESSAGE_FORMAT_SINGLE) or (config.shedder is not None):
+            process_batch(msg_cont.params, [(msg_cont.message['data'], start_time)])
+            return
+
         imgs = [msg_cont.message['data']]
-        preds = config.engine.infer_raw(imgs)
-        out_data = prediction_to_data(preds[0])
+        preds = infer_images(config, imgs)
+        if is_error(preds[0]):
+            log("process_images - %s" % preds[0]["error"])
+            return
+        out_data = prediction_to_data(preds[0], **config.output_options)
         msg_cont.params.redis.publish(msg_cont.params.channel_out, out_data)
+        if config.reduced_decode_check:
+            log("process_images - reduced decode check: %s" % str(config.engine.check_reduced_decode(imgs, preds)))
 
         if config.verbose:
             log("process_images - prediction image published: %s" % msg_cont.params.channel_out)
+            if config.engine.num_workers > 0:
+                log("process_images - pipeline stall: %d ms" % int(config.engine.last_stall_time * 1000))
+            if isinstance(config.engine, CachedEngine):
+                log("process_images - cache: %s" % config.engine.cache.stats())
             end_time = datetime.now()
             processing_time = end_time - start_time
             processing_time = int(processing_time.total_seconds() * 1000)
@@ -35,25 +292,181 @@ def process_image(msg_cont):
         log("process_images - failed to process: %s" % traceback.format_exc())
 
 
+def stats_file(path, index):
+    """
+    Generates the name of the statistics file for the worker.
+
+    :param path: the statistics file, can be None
+    :type path: str
+    :param index: the index of the worker
+    :type index: int
+    :return: the file name with the worker index appended, None if no file specified
+    :rtype: str
+    """
+    if path is None:
+        return None
+    return "%s-%d%s" % (os.path.splitext(path)[0], index, os.path.splitext(path)[1])
+
+
+def run_worker(parsed, config, index, items):
+    """
+    Processes the images received by the parent process, in a forked worker process.
+
+    :param parsed: the parsed command-line arguments
+    :type parsed: argparse.Namespace
+    :param config: the configuration container with the engine
+    :type config: Container
+    :param index: the index of the worker
+    :type index: int
+    :param items: the queue with the (image data, time received) tuples
+    :type items: multiprocessing.Queue
+    """
+    if parsed.backend == BACKEND_DYGRAPH:
+        set_num_threads(parsed.num_threads)
+    try:
+        if parsed.streams:
+            if parsed.collect_stats:
+                report_stats(config.engine, log, interval=parsed.stats_interval, path=stats_file(parsed.stats_file, index))
+            run_consumer(parsed, config, "%s-%d" % (parsed.consumer, index))
+            return
+        params = configure_redis(parsed, config=config)
+        if parsed.collect_stats:
+            report_stats(config.engine, log, interval=parsed.stats_interval, path=stats_file(parsed.stats_file, index))
+        max_batch_size = 1
+        if parsed.micro_batching:
+            max_batch_size = parsed.max_batch_size
+            if max_batch_size is None:
+                max_batch_size = config.engine.config["Infer"]["batch_size"]
+        config.batcher = MicroBatcher(partial(process_batch, params), max_batch_size, parsed.max_wait_ms, items=items)
+        config.batcher.run()
+    finally:
+        # the worker process exits without running atexit handlers
+        run_shutdown()
+
+
 if __name__ == '__main__':
     parser = create_parser('PaddleClas - Prediction (Redis)', prog="paddleclas_predict_redis", prefix="redis_")
     parser.add_argument('--config', help='Path to the config file', required=True, default=None)
     parser.add_argument('--model_path', help='Path to the trained model (.pdparams file), overrides config file', required=False, default=None)
     parser.add_argument('--class_id_map_file', help='Path to the file with the class index/label mapping, overrides config file', required=False, default=None)
+    parser.add_argument('--backend', choices=BACKENDS, help='The backend for running the model; inference/onnx convert the model once (next to the .pdparams file) and use the Paddle Inference predictor/ONNX Runtime', required=False, default=BACKEND_DYGRAPH)
+    parser.add_argument('--precision', choices=PRECISIONS, help='The precision of the model for the inference backend; int8 requires the model generated by paddleclas_quantize', required=False, default=PRECISION_FP32)
+    parser.add_argument('--num_threads', type=int, help='The number of CPU threads for the inference backend (uses all cores if not specified) or the intra-op threads for the onnx backend', required=False, default=None)
+    parser.add_argument('--inter_op_threads', type=int, help='The number of inter-op threads for the onnx backend', required=False, default=None)
+    parser.add_argument('--num_workers', type=int, help='The number of threads for preprocessing the next batch while the model runs on the current one, 0 for serial preprocessing', required=False, default=0)
+    parser.add_argument('--vectorized_preprocess', action='store_true', help='Whether to decode/resize/crop each image into a preallocated batch buffer and normalize the whole batch at once (requires the Infer transforms DecodeImage/ResizeImage/CropImage, NormalizeImage, ToCHWImage)', required=False, default=False)
+    parser.add_argument('--reduced_decode', action='store_true', help='Whether to decode JPEGs at a reduced scale (1/2, 1/4, 1/8) if they are still at least as large as the ResizeImage target', required=False, default=False)
+    parser.add_argument('--reduced_decode_check', action='store_true', help='Whether to also run the images decoded at full resolution through the model and log the agreement with the reduced decoding (for evaluation only, doubles the inference time)', required=False, default=False)
+    parser.add_argument('--num_procs', type=int, help='The number of worker processes to fork after loading the model (sharing its memory copy-on-write), 0 for single-process mode; the workers get restarted if they die; --num_threads applies per worker (default: number of cores divided by the number of workers; CPU only)', required=False, default=0)
+    parser.add_argument('--message_format', choices=MESSAGE_FORMATS, help='The format of the incoming messages; single: one image per message and one JSON object with the predictions per image; multi: multiple images plus request ID per message (see predict_protocol.py) and one JSON object with the request ID and the list of predictions per message', required=False, default=MESSAGE_FORMAT_SINGLE)
+    parser.add_argument('--shared_memory', action='store_true', help='Whether to accept references to images in POSIX shared memory segments (named --shm_prefix...) or memory-mapped files (in --shm_dir) instead of the images themselves, for clients on the same host (see predict_shm.py)', required=False, default=False)
+    parser.add_argument('--shm_prefix', help='The prefix that the names of shared memory segments referenced in shared memory mode must start with (segments referenced with the release flag get unlinked), segment references are rejected if not specified', required=False, default=None)
+    parser.add_argument('--shm_dir', help='The directory that memory-mapped files referenced in shared memory mode must be located in, file references are rejected if not specified', required=False, default=None)
+    parser.add_argument('--streams', action='store_true', help='Whether to read the images from a Redis stream (--redis_in, field: data) via a consumer group and append the predictions to a stream (--redis_out, fields: id, data or error) instead of using pub/sub', required=False, default=False)
+    parser.add_argument('--group', help='The consumer group to join in streams mode', required=False, default="paddleclas")
+    parser.add_argument('--consumer', help='The consumer name in streams mode (worker index gets appended in multi-process mode), defaults to HOSTNAME-PID', required=False, default=None)
+    parser.add_argument('--block_ms', type=int, help='The maximum time in milliseconds to wait for new entries in streams mode', required=False, default=1000)
+    parser.add_argument('--claim_idle_ms', type=int, help='The time in milliseconds after which unacknowledged entries of other consumers get reclaimed in streams mode', required=False, default=60000)
+    parser.add_argument('--max_deliveries', type=int, help='The number of deliveries after which entries that keep failing get an error appended to the output stream and acknowledged in streams mode, no limit if <= 0', required=False, default=5)
+    parser.add_argument('--stream_maxlen', type=int, help='The approximate maximum length of the output stream in streams mode, no trimming if not specified', required=False, default=None)
+    parser.add_argument('--max_age_ms', type=float, help='The maximum age in milliseconds of messages (since enqueued according to their deadline envelope, otherwise since received) before they get shed, no limit if not specified; messages with an absolute deadline in their envelope get shed once it has passed (see predict_shedding.py)', required=False, default=None)
+    parser.add_argument('--expired', choices=EXPIRED_POLICIES, help='How to handle expired messages; drop: discard them; fail: publish an error', required=False, default=EXPIRED_DROP)
+    parser.add_argument('--max_queue_size', type=int, help='The maximum number of messages waiting in the queue for micro-batching/asyncio receiving or of a worker, unbounded if <= 0', required=False, default=0)
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, help='How to handle messages arriving while the queue is full', required=False, default=OVERFLOW_BLOCK)
+    parser.add_argument('--load_shedding', action='store_true', help='Whether to check messages for deadline envelopes and shed expired messages before decoding (implied by --max_age_ms)', required=False, default=False)
+    parser.add_argument('--async_receive', action='store_true', help='Whether to receive the images with an asyncio client into a queue (see --max_queue_size/--overflow), run the batches collected from the queue (see --max_batch_size/--max_wait_ms) in a separate inference thread and publish the predictions through a pipelined client, overlapping network I/O and inference (pub/sub, single-process mode only)', required=False, default=False)
+    parser.add_argument('--micro_batching', action='store_true', help='Whether to collect incoming images and run them through the model in batches', required=False, default=False)
+    parser.add_argument('--max_batch_size', type=int, help='The maximum number of images per batch in micro-batching/asyncio receiving mode (entries to read at a time in streams mode), uses Infer.batch_size from the config if not specified', required=False, default=None)
+    parser.add_argument('--max_wait_ms', type=float, help='The maximum time in milliseconds to wait for further images after the first image of a batch arrived in micro-batching/asyncio receiving mode', required=False, default=10.0)
+    parser.add_argument('--top_k', type=int, help='The maximum number of classes (highest scores first) to output, all if not specified', required=False, default=None)
+    parser.add_argument('--score_threshold', type=float, help='The minimum score for classes to output, all if not specified', required=False, default=None)
+    parser.add_argument('--score_precision', type=int, help='The number of decimals to round the scores to, no rounding if not specified', required=False, default=None)
+    parser.add_argument('--cache_size', type=int, help='The maximum number of predictions to cache (keyed by a hash of the image bytes), 0 to disable the cache', required=False, default=0)
+    parser.add_argument('--cache_memory', type=float, help='The maximum memory in MB to use for the cached predictions, no limit if not specified', required=False, default=None)
+    parser.add_argument('--collect_stats', action='store_true', help='Whether to record the latencies of the inference stages (decode, preprocessing operators, to_tensor, forward, postprocess) and the batch sizes', required=False, default=False)
+    parser.add_argument('--stats_interval', type=float, help='The interval in seconds for outputting the statistics, only on shutdown if <= 0', required=False, default=60.0)
+    parser.add_argument('--stats_file', help='The JSON file to save the statistics to as well', required=False, default=None)
     parser.add_argument('--verbose', action='store_true', help='Whether to output more logging info', required=False, default=False)
     parsed = parser.parse_args()
 
     try:
+        if (parsed.num_procs > 0) and (parsed.num_threads is None):
+            parsed.num_threads = max(1, os.cpu_count() // parsed.num_procs)
         eng = load_model(parsed.config, model_path=parsed.model_path,
                          class_id_map_file=parsed.class_id_map_file,
+                         num_workers=parsed.num_workers, backend=parsed.backend,
+                         num_threads=parsed.num_threads, inter_op_threads=parsed.inter_op_threads,
+                         precision=parsed.precision, collect_stats=parsed.collect_stats,
+                         vectorized=parsed.vectorized_preprocess, reduced_decode=parsed.reduced_decode,
                          device="cpu")
+        if (parsed.num_procs > 0) and (eng.config["Global"]["device"] != "cpu"):
+            raise Exception("Multi-process mode (--num_procs) is only supported on CPU!")
+        if parsed.collect_stats and (parsed.num_procs <= 0):
+            report_stats(eng, log, interval=parsed.stats_interval, path=parsed.stats_file)
+        if parsed.cache_size > 0:
+            cache_memory = int(parsed.cache_memory * 1024 * 1024) if parsed.cache_memory is not None else None
+            eng = CachedEngine(eng, PredictionCache(eng.fingerprint, max_entries=parsed.cache_size, max_memory=cache_memory))
 
         config = Container()
         config.engine = eng
         config.verbose = parsed.verbose
+        config.message_format = parsed.message_format
+        config.shared_memory = parsed.shared_memory
+        config.shm_dir = parsed.shm_dir
+        config.shm_prefix = parsed.shm_prefix
+        config.reduced_decode_check = parsed.reduced_decode and parsed.reduced_decode_check
+        config.output_options = dict(top_k=parsed.top_k, threshold=parsed.score_threshold,
+                                     precision=parsed.score_precision)
+        config.batcher = None
+        config.receiver = None
+        config.shedder = None
+        if parsed.load_shedding or (parsed.max_age_ms is not None):
+            config.shedder = LoadShedder(max_age_ms=parsed.max_age_ms, expired=parsed.expired)
+        if ((config.shedder is not None) or (parsed.max_queue_size > 0)) and (parsed.num_procs <= 0):
+            on_shutdown(lambda: log("load shedding - %s" % load_stats(config)))
 
-        params = configure_redis(parsed, config=config)
-        run_harness(params, process_image)
+        if parsed.consumer is None:
+            parsed.consumer = default_consumer()
+
+        if parsed.async_receive and (parsed.streams or (parsed.num_procs > 0)):
+            raise Exception("Asyncio receiving (--async_receive) is not supported in streams/multi-process mode!")
+
+        if parsed.streams and (parsed.num_procs > 0):
+            # the workers join the consumer group themselves
+            pool = WorkerPool(parsed.num_procs, partial(run_worker, parsed, config))
+            pool.start()
+            pool.supervise()
+        elif parsed.streams:
+            run_consumer(parsed, config, parsed.consumer)
+        elif parsed.num_procs > 0:
+            # the parent only receives the images and hands them to the workers
+            pool = WorkerPool(parsed.num_procs, partial(run_worker, parsed, config),
+                              max_queue_size=parsed.max_queue_size, overflow=parsed.overflow)
+            pool.start()
+            if parsed.max_queue_size > 0:
+                on_shutdown(lambda: log("load shedding - dropped: %d" % pool.dropped))
+            params = configure_redis(parsed)
+            params.pubsub.psubscribe(**{params.channel_in: lambda message: pool.put((message['data'], datetime.now()))})
+            params.pubsub.run_in_thread(sleep_time=params.timeout, daemon=True)
+            pool.supervise()
+        elif parsed.async_receive:
+            max_batch_size = parsed.max_batch_size
+            if max_batch_size is None:
+                max_batch_size = eng.config["Infer"]["batch_size"]
+            config.receiver = AsyncReceiver(parsed, partial(predict_batch, config), max_batch_size, parsed.max_wait_ms,
+                                            max_queue_size=parsed.max_queue_size, overflow=parsed.overflow)
+            config.receiver.verbose = parsed.verbose
+            config.receiver.run()
+        else:
+            params = configure_redis(parsed, config=config)
+            if parsed.micro_batching:
+                max_batch_size = parsed.max_batch_size
+                if max_batch_size is None:
+                    max_batch_size = eng.config["Infer"]["batch_size"]
+                config.batcher = MicroBatcher(partial(process_batch, params), max_batch_size, parsed.max_wait_ms,
+                                              max_queue_size=parsed.max_queue_size, overflow=parsed.overflow)
+                config.batcher.start()
+            run_harness(params, process_image)
 
     except Exception as e:
         print(traceback.format_exc())
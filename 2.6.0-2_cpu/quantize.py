@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import traceback
+from typing import List, Optional
+
+import numpy as np
+import paddle
+from paddle.static.quantization import PostTrainingQuantization
+
+from predict_backends import PaddleInferencePredictor, PRECISION_FP32, PRECISION_INT8, INT8_SUFFIX, export_static, model_prefix
+from predict_common import load_model
+
+
+SUPPORTED_EXTS = [".jpg", ".jpeg", ".png", ".bmp"]
+""" supported file extensions (lower case). """
+
+ALGOS = ["KL", "hist", "avg", "mse", "abs_max"]
+""" the available calibration algorithms. """
+
+
+def list_images(image_dir: str) -> List[str]:
+    """
+    Lists the images in the directory.
+
+    :param image_dir: the directory to list the images in
+    :type image_dir: str
+    :return: the sorted list of images
+    :rtype: list
+    """
+    result = []
+    for f in sorted(os.listdir(image_dir)):
+        if os.path.splitext(f)[1].lower() in SUPPORTED_EXTS:
+            result.append(os.path.join(image_dir, f))
+    return result
+
+
+def load_annotations(annotations: str) -> List:
+    """
+    Loads the annotations file (format: 'PATH LABEL'; one per line, PATH relative to the file's directory).
+
+    :param annotations: the annotations file to load
+    :type annotations: str
+    :return: the list of (image path, label index) tuples
+    :rtype: list
+    """
+    result = []
+    root = os.path.dirname(annotations)
+    with open(annotations, "r") as fp:
+        for line in fp.readlines():
+            parts = line.strip().split(" ")
+            if len(parts) < 2:
+                continue
+            result.append((os.path.join(root, parts[0]), int(parts[1])))
+    return result
+
+
+def preprocessed_batches(engine, files: List[str], batch_size: int):
+    """
+    Generator for batches of preprocessed images.
+
+    :param engine: the engine to use for preprocessing
+    :type engine: CustomEngine
+    :param files: the image files to load
+    :type files: list
+    :param batch_size: the number of images per batch
+    :type batch_size: int
+    :return: the preprocessed batches (NCHW, float32)
+    """
+    batch = []
+    for f in files:
+        with open(f, "rb") as fp:
+            batch.append(engine.preprocess(fp.read()))
+        if len(batch) == batch_size:
+            yield np.asarray(batch, dtype="float32")
+            batch = []
+    if len(batch) > 0:
+        yield np.asarray(batch, dtype="float32")
+
+
+def quantize(engine, model_path: str, calibration_dir: str, output_prefix: Optional[str] = None,
+             batch_size: int = 10, batch_nums: Optional[int] = None, algo: str = "KL") -> str:
+    """
+    Generates an INT8 model via calibration-based post-training quantization.
+
+    :param engine: the engine with the loaded FP32 model
+    :type engine: CustomEngine
+    :param model_path: the path to the trained model (.pdparams file)
+    :type model_path: str
+    :param calibration_dir: the directory with the calibration images
+    :type calibration_dir: str
+    :param output_prefix: the path prefix for the INT8 model, uses the model path with suffix _int8 if None
+    :type output_prefix: str
+    :param batch_size: the number of calibration images per batch
+    :type batch_size: int
+    :param batch_nums: the number of calibration batches to use, all if None
+    :type batch_nums: int
+    :param algo: the calibration algorithm, e.g., KL, hist, avg, mse or abs_max
+    :type algo: str
+    :return: the path prefix of the INT8 model
+    :rtype: str
+    """
+    files = list_images(calibration_dir)
+    if len(files) == 0:
+        raise Exception("No calibration images found in: %s" % calibration_dir)
+    if output_prefix is None:
+        output_prefix = model_prefix(model_path) + INT8_SUFFIX
+    prefix = export_static(engine, model_path)
+
+    def batch_generator():
+        for batch in preprocessed_batches(engine, files, batch_size):
+            yield [batch]
+
+    print("Calibrating with %d image(s) using %s" % (len(files), algo))
+    paddle.enable_static()
+    try:
+        ptq = PostTrainingQuantization(
+            executor=paddle.static.Executor(paddle.CPUPlace()),
+            model_dir=os.path.dirname(os.path.abspath(prefix)),
+            model_filename=os.path.basename(prefix) + ".pdmodel",
+            params_filename=os.path.basename(prefix) + ".pdiparams",
+            batch_generator=batch_generator,
+            batch_nums=batch_nums,
+            algo=algo,
+            quantizable_op_type=["conv2d", "depthwise_conv2d", "mul", "matmul", "matmul_v2"],
+            onnx_format=True)
+        ptq.quantize()
+        ptq.save_quantized_model(os.path.dirname(output_prefix),
+                                 model_filename=os.path.basename(output_prefix) + ".pdmodel",
+                                 params_filename=os.path.basename(output_prefix) + ".pdiparams")
+    finally:
+        paddle.disable_static()
+    print("INT8 model saved to: %s" % output_prefix)
+    return output_prefix
+
+
+def top1_predictions(engine, predictor, annotations: List, batch_size: int) -> np.ndarray:
+    """
+    Determines the top-1 predictions of the predictor for the annotated images.
+
+    :param engine: the engine to use for preprocessing
+    :type engine: CustomEngine
+    :param predictor: the predictor to evaluate
+    :type predictor: PaddleInferencePredictor
+    :param annotations: the list of (image path, label index) tuples
+    :type annotations: list
+    :param batch_size: the number of images per batch
+    :type batch_size: int
+    :return: the predicted label indices
+    :rtype: np.ndarray
+    """
+    result = []
+    for batch in preprocessed_batches(engine, [x[0] for x in annotations], batch_size):
+        result.append(np.argmax(predictor.run(batch), axis=-1))
+    return np.concatenate(result)
+
+
+def report(engine, fp32_prefix: str, int8_prefix: str, val_annotations: str, batch_size: int = 10,
+           num_threads: Optional[int] = None) -> dict:
+    """
+    Compares the top-1 accuracy of the FP32 and INT8 models on the validation annotations.
+
+    :param engine: the engine to use for preprocessing
+    :type engine: CustomEngine
+    :param fp32_prefix: the path prefix of the FP32 static model
+    :type fp32_prefix: str
+    :param int8_prefix: the path prefix of the INT8 model
+    :type int8_prefix: str
+    :param val_annotations: the text file with the validation annotations/images relation
+    :type val_annotations: str
+    :param batch_size: the number of images per batch
+    :type batch_size: int
+    :param num_threads: the number of CPU threads to use, all cores if None
+    :type num_threads: int
+    :return: the report
+    :rtype: dict
+    """
+    annotations = load_annotations(val_annotations)
+    if len(annotations) == 0:
+        raise Exception("No annotations found in: %s" % val_annotations)
+    labels = np.asarray([x[1] for x in annotations])
+    fp32 = top1_predictions(engine, PaddleInferencePredictor(fp32_prefix, num_threads=num_threads, precision=PRECISION_FP32),
+                            annotations, batch_size)
+    int8 = top1_predictions(engine, PaddleInferencePredictor(int8_prefix, num_threads=num_threads, precision=PRECISION_INT8),
+                            annotations, batch_size)
+    result = {
+        "images": len(annotations),
+        "fp32_accuracy": float(np.mean(fp32 == labels)),
+        "int8_accuracy": float(np.mean(int8 == labels)),
+        "agreement": float(np.mean(fp32 == int8)),
+    }
+    result["delta"] = result["int8_accuracy"] - result["fp32_accuracy"]
+    return result
+
+
+def main(args=None):
+    """
+    Performs the post-training quantization.
+    Use -h to see all options.
+
+    :param args: the command-line arguments to use, uses sys.argv if None
+    :type args: list
+    """
+    parser = argparse.ArgumentParser(
+        description='Generates an INT8 model from a trained PaddleClas model via calibration-based post-training quantization, for use with: --backend inference --precision int8',
+        prog="paddleclas_quantize",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', help='Path to the config file', required=True, default=None)
+    parser.add_argument('--model_path', help='Path to the trained model (.pdparams file), overrides config file', required=False, default=None)
+    parser.add_argument('--calibration_dir', help='Path to the directory with the calibration images', required=True, default=None)
+    parser.add_argument('--output', help='The path prefix for the INT8 model (.pdmodel/.pdiparams), uses the model path with suffix %s if not specified' % INT8_SUFFIX, required=False, default=None)
+    parser.add_argument('--algo', choices=ALGOS, help='The calibration algorithm', required=False, default="KL")
+    parser.add_argument('--batch_size', type=int, help='The number of images per calibration/evaluation batch', required=False, default=10)
+    parser.add_argument('--batch_nums', type=int, help='The number of calibration batches to use, uses all if not specified', required=False, default=None)
+    parser.add_argument('--val_annotations', help='The text file with the validation annotations for reporting the accuracy delta vs FP32', required=False, default=None)
+    parser.add_argument('--report', help='The JSON file to save the accuracy report to', required=False, default=None)
+    parser.add_argument('--num_threads', type=int, help='The number of CPU threads for the evaluation, uses all cores if not specified', required=False, default=None)
+    parsed = parser.parse_args(args=args)
+
+    engine = load_model(parsed.config, model_path=parsed.model_path, device="cpu")
+    model_path = engine.config["Global"]["pretrained_model"]
+    int8_prefix = quantize(engine, model_path, parsed.calibration_dir, output_prefix=parsed.output,
+                           batch_size=parsed.batch_size, batch_nums=parsed.batch_nums, algo=parsed.algo)
+
+    if parsed.val_annotations is not None:
+        result = report(engine, export_static(engine, model_path), int8_prefix, parsed.val_annotations,
+                        batch_size=parsed.batch_size, num_threads=parsed.num_threads)
+        print("Images: %d" % result["images"])
+        print("FP32 accuracy: %.4f" % result["fp32_accuracy"])
+        print("INT8 accuracy: %.4f" % result["int8_accuracy"])
+        print("Delta: %+.4f" % result["delta"])
+        print("Top-1 agreement: %.4f" % result["agreement"])
+        if parsed.report is not None:
+            with open(parsed.report, "w") as fp:
+                json.dump(result, fp, indent=2)
+
+
+def sys_main():
+    """
+    Runs the main function using the system cli arguments, and
+    returns a system error code.
+
+    :return: 0 for success, 1 for failure.
+    :rtype: int
+    """
+
+    try:
+        main()
+        return 0
+    except Exception:
+        print(traceback.format_exc())
+        return 1
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        print(traceback.format_exc())
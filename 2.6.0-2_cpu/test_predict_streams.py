@@ -0,0 +1,119 @@
+import shutil
+import socket
+import subprocess
+import time
+
+import pytest
+
+redis = pytest.importorskip("redis")
+pytest.importorskip("rdh")
+if shutil.which("redis-server") is None:
+    pytest.skip("redis-server not available", allow_module_level=True)
+
+from predict_streams import StreamConsumer
+
+
+def free_port() -> int:
+    """
+    Determines a free TCP port on localhost.
+
+    :return: the port
+    :rtype: int
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def connection(tmp_path):
+    port = free_port()
+    proc = subprocess.Popen(["redis-server", "--port", str(port), "--bind", "127.0.0.1", "--save", "",
+                             "--appendonly", "no", "--dir", str(tmp_path)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    conn = redis.Redis(port=port)
+    try:
+        for _ in range(100):
+            try:
+                conn.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        else:
+            pytest.fail("redis-server did not start")
+        yield conn
+    finally:
+        conn.close()
+        proc.terminate()
+        proc.wait()
+
+
+def consumer(conn, **kwargs) -> StreamConsumer:
+    """
+    Creates a consumer for the "in"/"out" streams, with the consumer group already created.
+
+    :param conn: the redis connection to use
+    :type conn: redis.Redis
+    :param kwargs: the other parameters for the consumer
+    :return: the consumer
+    :rtype: StreamConsumer
+    """
+    result = StreamConsumer(conn, "in", "out", "group", "consumer", block_ms=10, **kwargs)
+    result.create_group()
+    return result
+
+
+def pending(conn) -> int:
+    return conn.xpending("in", "group")["pending"]
+
+
+def test_complete_without_fields_only_acknowledges(connection):
+    c = consumer(connection, batch_size=2)
+    connection.xadd("in", {"data": b"a"})
+    connection.xadd("in", {"data": b"b"})
+    entries = c.read()
+    c.complete([x[0] for x in entries], [{"data": b"A"}, None])
+    out = connection.xrange("out")
+    assert len(out) == 1
+    assert out[0][1][b"id"] == entries[0][0]
+    assert pending(connection) == 0
+
+
+def test_failed_batch_gets_retried_individually(connection):
+    c = consumer(connection, batch_size=3)
+    for data in [b"a", b"bad", b"b"]:
+        connection.xadd("in", {"data": data})
+
+    def process(imgs):
+        if b"bad" in imgs:
+            raise ValueError("bad image")
+        c.stopped = True
+        return [{"data": x.upper()} for x in imgs]
+
+    c.run(process)
+    assert sorted(x[1][b"data"] for x in connection.xrange("out")) == [b"A", b"B"]
+    assert pending(connection) == 1
+
+
+def test_entries_get_dead_lettered(connection):
+    c = consumer(connection, claim_idle_ms=0, max_deliveries=2)
+    connection.xadd("in", {"data": b"bad"})
+    assert len(c.read()) == 1
+    assert len(c.read()) == 1
+    assert len(c.read()) == 0
+    out = connection.xrange("out")
+    assert len(out) == 1
+    assert b"error" in out[0][1]
+    assert c.dead_lettered == 1
+    assert pending(connection) == 0
+
+
+def test_history_gets_read_once(connection):
+    c = consumer(connection, batch_size=2, max_deliveries=0)
+    connection.xadd("in", {"data": b"bad"})
+    assert len(c.read()) == 1
+    # restart: the pending entry gets delivered from the history once, then left to reclaiming
+    c = consumer(connection, batch_size=2, max_deliveries=0)
+    assert len(c.read()) == 1
+    assert len(c.read()) == 0
+    assert pending(connection) == 1
@@ -2,55 +2,735 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from typing import List
+import io
+import math
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, List, Optional, Tuple
 
+import cv2
+import numpy as np
 import paddle
+from PIL import Image
 
 from ppcls.engine.engine import Engine
 from ppcls.utils import logger
 
 
+def extract_logits(out):
+    """
+    Extracts the logits from the model output.
+
+    :param out: the output of the model
+    :return: the logits
+    """
+    if isinstance(out, list):
+        out = out[0]
+    if isinstance(out, dict) and "Student" in out:
+        out = out["Student"]
+    if isinstance(out, dict) and "logits" in out:
+        out = out["logits"]
+    if isinstance(out, dict) and "output" in out:
+        out = out["output"]
+    return out
+
+
+def batched(iterable: Iterable, n: int):
+    """
+    Generator that splits the iterable into lists of at most n items.
+
+    :param iterable: the items to split
+    :type iterable: iterable
+    :param n: the maximum number of items per list
+    :type n: int
+    :return: the lists of items
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, n))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+DECODE_OPS = ["DecodeImage", "ReducedDecodeImage"]
+""" the operators that decode the raw image bytes. """
+
+PIXELS_MAGIC = b"PCPX"
+""" the magic bytes that pre-decoded pixel payloads start with. """
+
+PIXELS_DTYPES = {1: np.uint8}
+""" the supported data types of pixel payloads (code -> dtype). """
+
+
+def is_pixels(data) -> bool:
+    """
+    Checks whether the data is a pre-decoded pixel payload.
+
+    :param data: the data to check
+    :return: True if a pixel payload
+    :rtype: bool
+    """
+    if isinstance(data, memoryview):
+        return data[:len(PIXELS_MAGIC)] == PIXELS_MAGIC
+    return isinstance(data, bytes) and data.startswith(PIXELS_MAGIC)
+
+
+def decode_pixels(data: bytes) -> np.ndarray:
+    """
+    Wraps the pixel payload as a (read-only, zero-copy) array. Format: magic bytes, data type code (uint8; 1=uint8),
+    number of dimensions (uint8), the dimensions (uint32 each; height, width, channels) and the pixels (RGB, HWC);
+    all integers little-endian.
+
+    :param data: the payload to decode
+    :type data: bytes or memoryview
+    :return: the image
+    :rtype: np.ndarray
+    """
+    dtype, ndim = struct.unpack_from("<BB", data, len(PIXELS_MAGIC))
+    if dtype not in PIXELS_DTYPES:
+        raise Exception("Unsupported data type code for pixels: {}".format(dtype))
+    offset = len(PIXELS_MAGIC) + 2
+    shape = struct.unpack_from("<%dI" % ndim, data, offset)
+    offset += 4 * ndim
+    if (ndim != 3) or (shape[2] != 3):
+        raise Exception("Pixels must have shape (height, width, 3), found: {}".format(shape))
+    return np.frombuffer(data, dtype=PIXELS_DTYPES[dtype], count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+PER_IMAGE_OPS = DECODE_OPS + ["ResizeImage", "CropImage"]
+""" the preprocessing operators that can precede the vectorized normalization (uint8 HWC in/out). """
+
+
+def split_preprocess_ops(ops: List) -> Optional[Tuple[List, object, bool]]:
+    """
+    Splits the preprocessing operators into the ones that get applied to each image and the
+    normalization (plus HWC to CHW transpose) that can get applied to the whole batch at once.
+
+    :param ops: the preprocessing operators
+    :type ops: list
+    :return: the per-image operators, the NormalizeImage operator and whether to transpose to CHW,
+             None if the operators are not supported for vectorized preprocessing
+    :rtype: tuple
+    """
+    names = [type(op).__name__ for op in ops]
+    if "NormalizeImage" not in names:
+        return None
+    idx = names.index("NormalizeImage")
+    normalize = ops[idx]
+    if any(name not in PER_IMAGE_OPS for name in names[:idx]):
+        return None
+    if any(getattr(op, "channel_first", False) for op in ops[:idx]):
+        return None
+    if (normalize.order == "chw") or (getattr(normalize, "output_dtype", "float32") != "float32") or (getattr(normalize, "channel_num", 3) != 3):
+        return None
+    if names[idx + 1:] not in ([], ["ToCHWImage"]):
+        return None
+    return ops[:idx], normalize, len(names[idx + 1:]) == 1
+
+
+REDUCTION_FACTORS = [8, 4, 2]
+""" the JPEG DCT scaling factors to try (largest first). """
+
+
+class ReducedDecodeImage(object):
+    """
+    Wraps the DecodeImage operator, decoding JPEGs at a reduced scale (1/2, 1/4, 1/8) via libjpeg's
+    DCT scaling if the image is still at least as large as the target of the ResizeImage operator
+    that follows. Other formats and images that are too small get decoded at full resolution.
+    """
+
+    def __init__(self, decode, resize):
+        """
+        Initializes the operator.
+
+        :param decode: the DecodeImage operator to wrap
+        :param resize: the ResizeImage operator following the decoding
+        """
+        self.decode = decode
+        self.resize = resize
+        self.backend = getattr(decode, "backend", "cv2")
+        self.channel_first = getattr(decode, "channel_first", False)
+        self.enabled = True
+
+    def factor(self, width: int, height: int) -> int:
+        """
+        Determines the reduction factor for the image dimensions.
+
+        :param width: the width of the image
+        :type width: int
+        :param height: the height of the image
+        :type height: int
+        :return: the reduction factor, 1 for full resolution
+        :rtype: int
+        """
+        for factor in REDUCTION_FACTORS:
+            w = math.ceil(width / factor)
+            h = math.ceil(height / factor)
+            if self.resize.resize_short is not None:
+                if min(w, h) >= self.resize.resize_short:
+                    return factor
+            elif (w >= self.resize.w) and (h >= self.resize.h):
+                return factor
+        return 1
+
+    def __call__(self, img):
+        if (not self.enabled) or (not isinstance(img, bytes)) or (not img.startswith(b"\xff\xd8")):
+            return self.decode(img)
+        pil = Image.open(io.BytesIO(img))
+        factor = self.factor(*pil.size)
+        if factor == 1:
+            return self.decode(img)
+        if self.backend == "pil":
+            pil.draft("RGB", (math.ceil(pil.size[0] / factor), math.ceil(pil.size[1] / factor)))
+            return self.decode(pil.convert("RGB"))
+        flags = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}[factor]
+        return self.decode(cv2.imdecode(np.frombuffer(img, dtype="uint8"), flags))
+
+
+def reduced_decode_ops(ops: List) -> Optional[List]:
+    """
+    Replaces the DecodeImage operator with ReducedDecodeImage, if it is directly followed by ResizeImage.
+
+    :param ops: the preprocessing operators
+    :type ops: list
+    :return: the updated operators, None if not applicable
+    :rtype: list
+    """
+    names = [type(op).__name__ for op in ops]
+    for i in range(len(names) - 1):
+        if (names[i] == "DecodeImage") and (names[i + 1] == "ResizeImage"):
+            return ops[:i] + [ReducedDecodeImage(ops[i], ops[i + 1])] + ops[i + 1:]
+    return None
+
+
+def error_result(msg: str) -> dict:
+    """
+    Generates the result for an image that could not be processed.
+
+    :param msg: the error message
+    :type msg: str
+    :return: the error result
+    :rtype: dict
+    """
+    return {"error": msg}
+
+
+def is_error(result) -> bool:
+    """
+    Checks whether the result is an error result.
+
+    :param result: the result to check
+    :return: True if an error result
+    :rtype: bool
+    """
+    return isinstance(result, dict) and ("error" in result)
+
+
+class StageStats(object):
+    """
+    Collects the latencies of the inference stages (decode, preprocessing operators, to_tensor,
+    forward, postprocess) and the batch sizes, keeping the most recent samples per stage.
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        """
+        Initializes the statistics.
+
+        :param max_samples: the maximum number of recent samples to keep per stage for the percentiles
+        :type max_samples: int
+        """
+        self.max_samples = max_samples
+        self._samples = dict()
+        self._counts = dict()
+        self._totals = dict()
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, value: float):
+        """
+        Records the value for the stage.
+
+        :param stage: the name of the stage
+        :type stage: str
+        :param value: the value to record (seconds for latencies)
+        :type value: float
+        """
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = deque(maxlen=self.max_samples)
+                self._counts[stage] = 0
+                self._totals[stage] = 0.0
+            self._samples[stage].append(value)
+            self._counts[stage] += 1
+            self._totals[stage] += value
+
+    def summary(self) -> dict:
+        """
+        Returns the statistics per stage: count, total, mean, p50, p95 and p99 (of the recent samples).
+
+        :return: the statistics, latencies in milliseconds
+        :rtype: dict
+        """
+        result = dict()
+        with self._lock:
+            for stage in self._samples:
+                factor = 1 if stage == "batch_size" else 1000.0
+                samples = np.asarray(self._samples[stage]) * factor
+                p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+                result[stage] = {
+                    "count": self._counts[stage],
+                    "total": self._totals[stage] * factor,
+                    "mean": self._totals[stage] * factor / self._counts[stage],
+                    "p50": float(p50),
+                    "p95": float(p95),
+                    "p99": float(p99),
+                }
+        return result
+
+    def report(self) -> str:
+        """
+        Generates a textual report of the statistics.
+
+        :return: the report
+        :rtype: str
+        """
+        lines = ["%-16s %10s %12s %10s %10s %10s %10s" % ("stage", "count", "total", "mean", "p50", "p95", "p99")]
+        for stage, stats in self.summary().items():
+            lines.append("%-16s %10d %12.1f %10.2f %10.2f %10.2f %10.2f"
+                         % (stage, stats["count"], stats["total"], stats["mean"], stats["p50"], stats["p95"], stats["p99"]))
+        return "\n".join(lines)
+
+
+class LogitsModel(paddle.nn.Layer):
+    """
+    Wrapper for exporting models, only returns the logits.
+    """
+
+    def __init__(self, model):
+        """
+        Initializes the wrapper.
+
+        :param model: the model to wrap
+        :type model: paddle.nn.Layer
+        """
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return extract_logits(self.model(x))
+
+
 class CustomEngine(Engine):
 
-    @paddle.no_grad()
-    def infer_raw(self, images: List) -> List:
+    def __init__(self, config, mode="train", num_workers=0, collect_stats=False, vectorized=False,
+                 reduced_decode=False):
         """
-        Runs inferences on the incoming images.
+        Initializes the engine.
 
-        :param images: the list of images to run inference on (images are in raw bytes)
+        :param config: the configuration to use
+        :type config: dict
+        :param mode: the mode of the engine, e.g., train or infer
+        :type mode: str
+        :param num_workers: the number of worker threads for preprocessing the next batch while the model
+                            runs on the current one (pipelined mode), 0 to preprocess serially
+        :type num_workers: int
+        :param collect_stats: whether to record the latencies of the inference stages
+        :type collect_stats: bool
+        :param vectorized: whether to normalize the images of a batch at once in a preallocated buffer,
+                           rather than running all the preprocessing operators per image
+        :type vectorized: bool
+        :param reduced_decode: whether to decode JPEGs at a reduced scale if they are much larger than the resize target
+        :type reduced_decode: bool
+        """
+        super().__init__(config, mode=mode)
+        self.stats = StageStats() if collect_stats else None
+        self.num_workers = num_workers
+        self.stall_time = 0.0
+        self.stall_count = 0
+        self.last_stall_time = 0.0
+        self.predictor = None
+        self._executor = None
+        self._vectorized = None
+        self._buffers = None
+        self._reduced_decode = None
+        if reduced_decode and (mode == "infer"):
+            ops = reduced_decode_ops(self.preprocess_func)
+            if ops is None:
+                logger.warning("Reduced decoding requires DecodeImage followed by ResizeImage, using full resolution: {}".format(
+                    ", ".join(type(op).__name__ for op in self.preprocess_func)))
+            else:
+                self.preprocess_func = ops
+                self._reduced_decode = [op for op in ops if isinstance(op, ReducedDecodeImage)][0]
+        if vectorized and (mode == "infer"):
+            self._vectorized = split_preprocess_ops(self.preprocess_func)
+            if self._vectorized is None:
+                logger.warning("Preprocessing operators not supported for vectorized preprocessing, using per-image preprocessing: {}".format(
+                    ", ".join(type(op).__name__ for op in self.preprocess_func)))
+
+    def close(self):
+        """
+        Shuts down the preprocessing workers (if any).
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _export_layer(self):
+        """
+        Prepares the model for exporting.
+
+        :return: the layer to export and the input spec
+        :rtype: tuple
+        """
+        self.model.eval()
+        # for re-parameterization nets
+        for layer in self.model.sublayers():
+            if hasattr(layer, "re_parameterize") and not getattr(layer, "is_repped", False):
+                layer.re_parameterize()
+        input_spec = [paddle.static.InputSpec(shape=[None] + self.config["Global"]["image_shape"], dtype="float32")]
+        return LogitsModel(self.model), input_spec
+
+    def export_static(self, path_prefix: str):
+        """
+        Exports the model as static graph via paddle.jit, generating the .pdmodel and .pdiparams files.
+
+        :param path_prefix: the path prefix for the generated files
+        :type path_prefix: str
+        """
+        layer, input_spec = self._export_layer()
+        model = paddle.jit.to_static(layer, input_spec=input_spec)
+        paddle.jit.save(model, path_prefix)
+        logger.info("Exported static model to: {}".format(path_prefix))
+
+    def export_onnx(self, path_prefix: str, opset_version: int = 11):
+        """
+        Exports the model in ONNX format via paddle2onnx, generating the .onnx file.
+
+        :param path_prefix: the path prefix for the generated file
+        :type path_prefix: str
+        :param opset_version: the ONNX opset version to use
+        :type opset_version: int
+        """
+        layer, input_spec = self._export_layer()
+        paddle.onnx.export(layer, path_prefix, input_spec=input_spec, opset_version=opset_version)
+        logger.info("Exported ONNX model to: {}.onnx".format(path_prefix))
+
+    def _forward(self, batch_data):
+        """
+        Runs the model (or the predictor, if set) on the preprocessed batch.
+
+        :param batch_data: the preprocessed images (list or array)
+        :return: the logits
+        """
+        start = time.perf_counter()
+        if self.predictor is not None:
+            batch = np.asarray(batch_data, dtype="float32")
+            start = self._record("to_tensor", start)
+            out = paddle.to_tensor(self.predictor.run(batch))
+            self._record("forward", start)
+            return out
+        batch_tensor = paddle.to_tensor(batch_data)
+        start = self._record("to_tensor", start)
+        with self.auto_cast(is_eval=True):
+            out = self.model(batch_tensor)
+        self._record("forward", start)
+        return extract_logits(out)
+
+    def _record(self, stage: str, start: float) -> float:
+        """
+        Records the time since the start for the stage, if statistics are being collected.
+
+        :param stage: the name of the stage
+        :type stage: str
+        :param start: the start time of the stage (perf_counter)
+        :type start: float
+        :return: the current time (perf_counter), i.e., the start of the next stage
+        :rtype: float
+        """
+        end = time.perf_counter()
+        if self.stats is not None:
+            self.stats.record(stage, end - start)
+        return end
+
+    def _apply(self, ops: List, image):
+        """
+        Applies the preprocessing operators to the image.
+
+        :param ops: the operators to apply
+        :type ops: list
+        :param image: the image to process
+        :return: the processed image
+        """
+        start = None
+        if is_pixels(image):
+            image = self._pixels_to_image(image, ops)
+            ops = [op for op in ops if type(op).__name__ not in DECODE_OPS]
+        elif isinstance(image, np.ndarray):
+            ops = [op for op in ops if type(op).__name__ not in DECODE_OPS]
+        elif isinstance(image, memoryview):
+            if (len(ops) > 0) and (type(ops[0]).__name__ == "DecodeImage") and (getattr(ops[0], "backend", "cv2") == "cv2"):
+                # decodes straight from the shared buffer rather than copying it, the decode operator then only
+                # converts color order/layout (the time counts towards the decode stage)
+                start = time.perf_counter()
+                image = cv2.imdecode(np.frombuffer(image, dtype="uint8"), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise Exception("Failed to decode image!")
+            else:
+                image = image.tobytes()
+        if self.stats is None:
+            for process in ops:
+                image = process(image)
+            return image
+        if start is None:
+            start = time.perf_counter()
+        for process in ops:
+            image = process(image)
+            name = type(process).__name__
+            start = self._record("decode" if name in DECODE_OPS else name, start)
+        return image
+
+    def _pixels_to_image(self, data: bytes, ops: List) -> np.ndarray:
+        """
+        Turns the pixel payload into an image as generated by the decode operator, skipping the decoding.
+
+        :param data: the pixel payload (RGB, HWC)
+        :type data: bytes or memoryview
+        :param ops: the operators to apply to the image
+        :type ops: list
+        :return: the image
+        :rtype: np.ndarray
+        """
+        start = time.perf_counter()
+        image = decode_pixels(data)
+        decode = [op for op in ops if type(op).__name__ in DECODE_OPS]
+        if len(decode) > 0:
+            if not getattr(decode[0], "to_rgb", True):
+                image = image[:, :, ::-1]
+            if getattr(decode[0], "channel_first", False):
+                image = image.transpose((2, 0, 1))
+        self._record("pixels", start)
+        return image
+
+    def decode(self, image) -> np.ndarray:
+        """
+        Applies only the decode operator to the image, e.g., for decoding it ahead of time in another thread.
+        The decoded image can be used in place of the raw bytes (the decode operator gets skipped then).
+
+        :param image: the image to decode (raw bytes or pixel payload)
+        :return: the decoded image
+        :rtype: np.ndarray
+        """
+        ops = self.preprocess_func if self._vectorized is None else self._vectorized[0]
+        decode = [op for op in ops if type(op).__name__ in DECODE_OPS]
+        if len(decode) == 0:
+            raise Exception("No decode operator in preprocessing: {}".format(", ".join(type(op).__name__ for op in ops)))
+        return self._apply(decode[:1], image)
+
+    def preprocess(self, image):
+        """
+        Applies the preprocessing operators to the image.
+
+        :param image: the image to process (raw bytes)
+        :return: the preprocessed image
+        """
+        return self._apply(self.preprocess_func, image)
+
+    def _preprocess_image(self, image):
+        """
+        Applies the per-image preprocessing operators to the image, i.e., all of them unless in vectorized mode.
+
+        :param image: the image to process (raw bytes)
+        :return: the (partially) preprocessed image
+        """
+        if self._vectorized is None:
+            return self.preprocess(image)
+        return self._apply(self._vectorized[0], image)
+
+    def _normalize_batch(self, images: List) -> np.ndarray:
+        """
+        Copies the images into the preallocated uint8 batch buffer and normalizes them in one go,
+        transposing them from NHWC to NCHW if required. The buffers get reused for subsequent
+        batches, i.e., the returned array is only valid until the next call.
+
+        :param images: the images to normalize (uint8, HWC, all of the same size)
         :type images: list
-        :return: the list of results
+        :return: the normalized batch (float32)
+        :rtype: np.ndarray
+        """
+        start = time.perf_counter()
+        _, normalize, to_chw = self._vectorized
+        n = len(images)
+        shape = images[0].shape
+        if (self._buffers is None) or (self._buffers[0].shape[1:] != shape) or (len(self._buffers[0]) < n):
+            size = max(n, self.config["Infer"]["batch_size"])
+            chw = (size, shape[2], shape[0], shape[1]) if to_chw else (size,) + shape
+            self._buffers = (np.empty((size,) + shape, dtype=np.uint8),
+                             np.empty((size,) + shape, dtype=np.float32),
+                             np.empty(chw, dtype=np.float32))
+        raw, hwc, out = (x[:n] for x in self._buffers)
+        for i, image in enumerate(images):
+            if image.shape != shape:
+                raise Exception("Image #{} has shape {} instead of {}, cannot batch".format(i, image.shape, shape))
+            raw[i] = image
+        np.multiply(raw, normalize.scale, out=hwc, dtype=np.float32)
+        hwc -= np.asarray(normalize.mean, dtype=np.float32).reshape(-1)
+        hwc /= np.asarray(normalize.std, dtype=np.float32).reshape(-1)
+        if to_chw:
+            np.copyto(out, hwc.transpose((0, 3, 1, 2)))
+        else:
+            out = hwc
+        self._record("normalize", start)
+        return out
+
+    def _collect(self, keys: List, futures: List) -> Tuple[List, List, List]:
+        """
+        Waits for the preprocessing of the batch to finish, recording the time spent waiting.
+
+        :param keys: the keys of the images in the batch
+        :type keys: list
+        :param futures: the futures of the images in the batch
+        :type futures: list
+        :return: the keys and preprocessed images of the successfully preprocessed images, the (key, error result) tuples of the failed ones
+        :rtype: tuple
+        """
+        result_keys = []
+        result = []
+        failed = []
+        start = time.perf_counter()
+        for key, future in zip(keys, futures):
+            try:
+                result.append(future.result())
+                result_keys.append(key)
+            except Exception as ex:
+                logger.error("Exception occurred when processing image {} with msg: {}".format(key, ex))
+                failed.append((key, error_result("Failed to preprocess image: {}".format(ex))))
+        stall = time.perf_counter() - start
+        if self.stats is not None:
+            self.stats.record("stall", stall)
+        self.stall_time += stall
+        self.stall_count += 1
+        self.last_stall_time += stall
+        return result_keys, result, failed
+
+    def _preprocessed_batches(self, items: Iterable, batch_size: int):
+        """
+        Generator for the preprocessed batches. In pipelined mode, the next batch gets preprocessed
+        by the workers while the caller runs the model on the current one. Only the current and the
+        next batch of raw images are held in memory.
+
+        :param items: the (key, image) tuples to preprocess (images are in raw bytes)
+        :type items: iterable
+        :param batch_size: the number of images per batch
+        :type batch_size: int
+        :return: the keys and preprocessed images per batch plus the (key, error result) tuples of the images that failed (tuple)
+        """
+        if self.num_workers <= 0:
+            for batch in batched(items, batch_size):
+                keys = []
+                batch_data = []
+                failed = []
+                for key, image in batch:
+                    try:
+                        batch_data.append(self._preprocess_image(image))
+                        keys.append(key)
+                    except Exception as ex:
+                        logger.error("Exception occurred when processing image {} with msg: {}".format(key, ex))
+                        failed.append((key, error_result("Failed to preprocess image: {}".format(ex))))
+                yield keys, batch_data, failed
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="preprocess")
+        pending = None
+        for batch in batched(items, batch_size):
+            futures = [self._executor.submit(self._preprocess_image, image) for _, image in batch]
+            if pending is not None:
+                yield self._collect(*pending)
+            pending = ([key for key, _ in batch], futures)
+        if pending is not None:
+            yield self._collect(*pending)
+
+    @paddle.no_grad()
+    def infer_stream(self, items: Iterable, batch_size: int = None):
+        """
+        Runs inferences on the incoming images, yielding the results as soon as their batch completes.
+        Accepts any iterable (e.g., a generator), which only gets consumed one batch ahead, keeping
+        the memory usage bounded for arbitrarily many images.
+
+        :param items: the (key, image) tuples to run inference on (images are in raw bytes), the keys are passed through
+        :type items: iterable
+        :param batch_size: the number of images per batch, uses Infer.batch_size from the config if None
+        :type batch_size: int
+        :return: the (key, result) tuples, images that failed get an error result (see is_error)
         """
         assert self.mode == "infer" and self.eval_mode == "classification"
-        results = []
-        batch_size = self.config["Infer"]["batch_size"]
+        if batch_size is None:
+            batch_size = self.config["Infer"]["batch_size"]
         self.model.eval()
-        batch_data = []
-        for idx, image in enumerate(images):
+        self.last_stall_time = 0.0
+        for keys, batch_data, failed in self._preprocessed_batches(items, batch_size):
+            for key, res in failed:
+                yield key, res
+            if len(batch_data) == 0:
+                continue
+            if self.stats is not None:
+                self.stats.record("batch_size", len(batch_data))
             try:
-                for process in self.preprocess_func:
-                    image = process(image)
-                batch_data.append(image)
-                if len(batch_data) >= batch_size or idx == len(images) - 1:
-                    batch_tensor = paddle.to_tensor(batch_data)
-
-                    with self.auto_cast(is_eval=True):
-                        out = self.model(batch_tensor)
-
-                    if isinstance(out, list):
-                        out = out[0]
-                    if isinstance(out, dict) and "Student" in out:
-                        out = out["Student"]
-                    if isinstance(out, dict) and "logits" in out:
-                        out = out["logits"]
-                    if isinstance(out, dict) and "output" in out:
-                        out = out["output"]
-
-                    result = self.postprocess_func(out, None)
-                    results.extend(result)
-                    batch_data.clear()
+                if self._vectorized is not None:
+                    batch_data = self._normalize_batch(batch_data)
+                out = self._forward(batch_data)
+                start = time.perf_counter()
+                result = self.postprocess_func(out, None)
+                self._record("postprocess", start)
             except Exception as ex:
-                logger.error("Exception occurred when processing image #{} with msg: {}".format(idx, ex))
-                continue
+                logger.error("Exception occurred when processing batch of {} image(s) with msg: {}".format(len(batch_data), ex))
+                result = [error_result("Failed to run inference on batch: {}".format(ex))] * len(keys)
+            for key, res in zip(keys, result):
+                yield key, res
+
+    @paddle.no_grad()
+    def infer_raw(self, images: List) -> List:
+        """
+        Runs inferences on the incoming images.
+
+        :param images: the list of images to run inference on (raw bytes, pixel payloads or decoded images, see decode)
+        :type images: list
+        :return: the list of results, aligned with the images; images that failed get an error result (see is_error)
+        """
+        results = [None] * len(images)
+        for idx, result in self.infer_stream(enumerate(images)):
+            results[idx] = result
         return results
 
+    def check_reduced_decode(self, images: List, preds: List = None) -> dict:
+        """
+        Compares the predictions obtained with reduced decoding against the ones from full-resolution decoding.
+
+        :param images: the images to check (raw bytes)
+        :type images: list
+        :param preds: the predictions obtained with reduced decoding, computed if None
+        :type preds: list
+        :return: the number of compared images, the top-1 agreement and the mean/max absolute difference of the top-1 scores
+        :rtype: dict
+        """
+        if self._reduced_decode is None:
+            raise Exception("Reduced decoding is not enabled!")
+        if preds is None:
+            preds = self.infer_raw(images)
+        self._reduced_decode.enabled = False
+        try:
+            full = self.infer_raw(images)
+        finally:
+            self._reduced_decode.enabled = True
+        pairs = [(f, p) for f, p in zip(full, preds) if not (is_error(f) or is_error(p))]
+        diffs = [abs(f["scores"][0] - p["scores"][0]) for f, p in pairs]
+        return {
+            "images": len(pairs),
+            "top1_agreement": float(np.mean([f["class_ids"][0] == p["class_ids"][0] for f, p in pairs])) if len(pairs) > 0 else 0.0,
+            "mean_score_diff": float(np.mean(diffs)) if len(pairs) > 0 else 0.0,
+            "max_score_diff": float(np.max(diffs)) if len(pairs) > 0 else 0.0,
+        }
@@ -1,10 +1,52 @@
+import atexit
+import hashlib
 import json
-from typing import Tuple
+import os
+import signal
+import threading
+import time
+import traceback
+from typing import Callable, List, Tuple
+
+import orjson
 from ppcls.engine.custom_engine import CustomEngine
 from ppcls.utils import config
+from predict_backends import BACKEND_DYGRAPH, BACKEND_INFERENCE, BACKEND_ONNX, PRECISION_FP32, PRECISION_INT8, INT8_SUFFIX
+from predict_backends import PaddleInferencePredictor, OnnxRuntimePredictor, export_static, export_onnx, model_prefix, check_backend
+
+
+def model_fingerprint(cfg: dict, backend: str = BACKEND_DYGRAPH, precision: str = PRECISION_FP32,
+                      reduced_decode: bool = False) -> str:
+    """
+    Generates a fingerprint for the model, taking the model file (path, size, timestamp), the
+    inference configuration, the backend, the precision and the decoding into account.
+
+    :param cfg: the configuration with the model path
+    :type cfg: dict
+    :param backend: the backend the model runs with
+    :type backend: str
+    :param precision: the precision of the model
+    :type precision: str
+    :param reduced_decode: whether JPEGs get decoded at a reduced scale
+    :type reduced_decode: bool
+    :return: the fingerprint (hex digest)
+    :rtype: str
+    """
+    parts = [str(cfg["Global"].get("pretrained_model")), backend, precision]
+    if cfg["Global"].get("pretrained_model") is not None:
+        params = model_prefix(cfg["Global"]["pretrained_model"]) + ".pdparams"
+        if os.path.exists(params):
+            parts.extend([str(os.path.getsize(params)), str(os.path.getmtime(params))])
+    parts.append(json.dumps(cfg.get("Infer"), sort_keys=True, default=str))
+    if reduced_decode:
+        parts.append("reduced_decode")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
 
 
-def load_model(config_path: str, model_path: str = None, class_id_map_file: str = None, device: str = "cpu") -> Tuple:
+def load_model(config_path: str, model_path: str = None, class_id_map_file: str = None, device: str = "cpu",
+               num_workers: int = 0, backend: str = BACKEND_DYGRAPH, num_threads: int = None,
+               inter_op_threads: int = None, precision: str = PRECISION_FP32, collect_stats: bool = False,
+               vectorized: bool = False, reduced_decode: bool = False) -> Tuple:
     """
     Loads the model.
 
@@ -16,9 +58,26 @@ def load_model(config_path: str, model_path: str = None, class_id_map_file: str
     :type class_id_map_file: str
     :param device: the device to use, e.g., gpu or cpu
     :type device: str
+    :param num_workers: the number of threads for preprocessing the next batch while the model runs on the current one, 0 for serial preprocessing
+    :type num_workers: int
+    :param backend: the backend to run the model with, e.g., dygraph, inference or onnx
+    :type backend: str
+    :param num_threads: the number of CPU threads for the inference backend (all cores if None) or the intra-op threads for the onnx backend (ONNX Runtime default if None)
+    :type num_threads: int
+    :param inter_op_threads: the number of inter-op threads for the onnx backend, ONNX Runtime default if None
+    :type inter_op_threads: int
+    :param precision: the precision of the model for the inference backend, e.g., fp32 or int8 (requires the model generated by paddleclas_quantize)
+    :type precision: str
+    :param collect_stats: whether to record the latencies of the inference stages
+    :type collect_stats: bool
+    :param vectorized: whether to normalize the images of a batch at once rather than running all the preprocessing operators per image
+    :type vectorized: bool
+    :param reduced_decode: whether to decode JPEGs at a reduced scale (1/2, 1/4, 1/8) if they are still at least as large as the ResizeImage target
+    :type reduced_decode: bool
     :return: the engine for performing inference
     :rtype: CustomEngine
     """
+    check_backend(backend, precision, device)
     cfg = config.get_config(config_path, show=False)
     if model_path is not None:
         cfg["Global"]["pretrained_model"] = model_path
@@ -29,36 +88,179 @@ def load_model(config_path: str, model_path: str = None, class_id_map_file: str
             cfg["Infer"]["PostProcess"] = dict()
         cfg["Infer"]["PostProcess"]["class_id_map_file"] = class_id_map_file
     cfg["Global"]["device"] = device
-    engine = CustomEngine(cfg, mode="infer")
+    engine = CustomEngine(cfg, mode="infer", num_workers=num_workers, collect_stats=collect_stats,
+                          vectorized=vectorized, reduced_decode=reduced_decode)
+    if backend == BACKEND_INFERENCE:
+        if precision == PRECISION_INT8:
+            prefix = model_prefix(cfg["Global"]["pretrained_model"]) + INT8_SUFFIX
+            if not os.path.exists(prefix + ".pdmodel"):
+                raise Exception("INT8 model not found, use paddleclas_quantize to generate it: %s" % prefix)
+        else:
+            prefix = export_static(engine, cfg["Global"]["pretrained_model"])
+        engine.predictor = PaddleInferencePredictor(prefix, device=device, num_threads=num_threads,
+                                                    precision=precision)
+    elif backend == BACKEND_ONNX:
+        path = export_onnx(engine, cfg["Global"]["pretrained_model"])
+        engine.predictor = OnnxRuntimePredictor(path, device=device, intra_op_threads=num_threads,
+                                                inter_op_threads=inter_op_threads)
+    engine.fingerprint = model_fingerprint(cfg, backend=backend, precision=precision,
+                                           reduced_decode=engine._reduced_decode is not None)
     return engine
 
 
-def prediction_to_file(prediction, path: str) -> str:
+_shutdown_functions = []
+""" the functions to run on shutdown, see on_shutdown. """
+
+
+def run_shutdown():
+    """
+    Runs the functions registered via on_shutdown (most recent first), each one only once.
+    """
+    while len(_shutdown_functions) > 0:
+        function = _shutdown_functions.pop()
+        try:
+            function()
+        except Exception:
+            print(traceback.format_exc())
+
+
+def _terminate(signum, frame):
+    """
+    Turns SIGTERM (e.g., from docker stop) into SystemExit, so that the finally blocks and atexit handlers run.
+    If the main thread has finished already (i.e., the interpreter waits for other threads, like the pub/sub
+    thread of the redis harness), the shutdown functions get run directly instead.
+    """
+    if not threading.main_thread().is_alive():
+        run_shutdown()
+        os._exit(128 + signum)
+    raise SystemExit(128 + signum)
+
+
+def on_shutdown(function: Callable):
+    """
+    Registers the function to run on shutdown: when the interpreter exits, including on SIGTERM (unless another
+    handler is installed already, e.g., by WorkerPool). Forked worker processes exit without running atexit
+    handlers, they have to call run_shutdown themselves.
+
+    :param function: the function to run (no arguments)
+    """
+    _shutdown_functions.append(function)
+    if (threading.current_thread() is threading.main_thread()) and (signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+        signal.signal(signal.SIGTERM, _terminate)
+
+
+atexit.register(run_shutdown)
+# forked processes only run the functions they register themselves
+os.register_at_fork(after_in_child=_shutdown_functions.clear)
+
+
+def report_stats(engine, log: Callable, interval: float = 0, path: str = None):
+    """
+    Outputs the latency statistics of the engine periodically and on shutdown (see on_shutdown).
+
+    :param engine: the engine collecting the statistics
+    :type engine: CustomEngine
+    :param log: the function to use for outputting the report
+    :param interval: the interval in seconds for outputting the statistics, only on shutdown if <= 0
+    :type interval: float
+    :param path: the JSON file to save the statistics to as well, ignored if None
+    :type path: str
+    """
+    def output():
+        log("Stage statistics (latencies in ms):\n%s" % engine.stats.report())
+        if path is not None:
+            with open(path, "w") as fp:
+                json.dump(engine.stats.summary(), fp, indent=2)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            output()
+
+    if interval > 0:
+        threading.Thread(target=run, name="stats-report", daemon=True).start()
+    on_shutdown(output)
+
+
+def prediction_to_file(prediction, path: str, top_k: int = None, threshold: float = None,
+                       precision: int = None) -> str:
     """
     Saves the predictions to disk as JSON file.
 
     :param prediction: the paddleclas prediction object
     :param path: the path to save the image to
     :type path: str
+    :param top_k: the maximum number of classes (highest scores first) to output, all if None
+    :type top_k: int
+    :param threshold: the minimum score for classes to output, all if None
+    :type threshold: float
+    :param precision: the number of decimals to round the scores to, no rounding if None
+    :type precision: int
     :return: the filename the predictions were saved under
     :rtype: str
     """
-    content = prediction_to_data(prediction)
-    with open(path, "w") as fp:
+    content = prediction_to_data(prediction, top_k=top_k, threshold=threshold, precision=precision)
+    with open(path, "wb") as fp:
         fp.write(content)
-        fp.write("\n")
+        fp.write(b"\n")
     return path
 
 
-def prediction_to_data(prediction) -> str:
+def prediction_to_list(prediction, top_k: int = None, threshold: float = None, precision: int = None) -> List[Tuple]:
+    """
+    Turns the prediction into a list of class ID/label/score tuples.
+
+    :param prediction: the paddleclas prediction object
+    :param top_k: the maximum number of classes (highest scores first) to output, all if None
+    :type top_k: int
+    :param threshold: the minimum score for classes to output, all if None
+    :type threshold: float
+    :param precision: the number of decimals to round the scores to, no rounding if None
+    :type precision: int
+    :return: the list of (class ID, label, score) tuples
+    :rtype: list
+    """
+    class_ids = prediction.get("class_ids", [None] * len(prediction["scores"]))
+    result = zip(class_ids, prediction["label_names"], prediction["scores"])
+    if threshold is not None:
+        result = [x for x in result if x[2] >= threshold]
+    if top_k is not None:
+        result = sorted(result, key=lambda x: x[2], reverse=True)[:top_k]
+    if precision is not None:
+        return [(class_id, label, round(score, precision)) for class_id, label, score in result]
+    return list(result)
+
+
+def prediction_to_dict(prediction, top_k: int = None, threshold: float = None, precision: int = None) -> dict:
     """
-    Turns the mask prediction into bytes using the specified image format.
+    Turns the prediction into a dictionary of label/score pairs.
 
     :param prediction: the paddleclas prediction object
+    :param top_k: the maximum number of classes (highest scores first) to output, all if None
+    :type top_k: int
+    :param threshold: the minimum score for classes to output, all if None
+    :type threshold: float
+    :param precision: the number of decimals to round the scores to, no rounding if None
+    :type precision: int
+    :return: the dictionary with the class probabilities
+    :rtype: dict
+    """
+    return {label: score for _, label, score in prediction_to_list(prediction, top_k=top_k, threshold=threshold,
+                                                                   precision=precision)}
+
+
+def prediction_to_data(prediction, top_k: int = None, threshold: float = None, precision: int = None) -> bytes:
+    """
+    Turns the prediction into JSON bytes.
+
+    :param prediction: the paddleclas prediction object
+    :param top_k: the maximum number of classes (highest scores first) to output, all if None
+    :type top_k: int
+    :param threshold: the minimum score for classes to output, all if None
+    :type threshold: float
+    :param precision: the number of decimals to round the scores to, no rounding if None
+    :type precision: int
     :return: the generated JSON with the class probabilities
-    :rtype: str
+    :rtype: bytes
     """
-    result = {}
-    for i in range(len(prediction["label_names"])):
-        result[prediction["label_names"][i]] = prediction["scores"][i]
-    return json.dumps(result)
+    return orjson.dumps(prediction_to_dict(prediction, top_k=top_k, threshold=threshold, precision=precision))
@@ -0,0 +1,150 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+
+class Prefetcher(object):
+    """
+    Reads upcoming files in a thread pool, so that the I/O overlaps with the inference. Each file only
+    gets read once: the completeness check operates on the same buffer that gets handed on for inference.
+    Optionally, the files get decoded in the pool as well.
+    """
+
+    def __init__(self, num_threads: int, check: Callable[[bytes], bool] = None, decode: Callable = None):
+        """
+        Initializes the prefetcher.
+
+        :param num_threads: the number of threads for reading/decoding
+        :type num_threads: int
+        :param check: the function for checking whether the file content is complete, None to skip the check
+        :param decode: the function for decoding the file content (e.g., CustomEngine.decode), None to hand on the raw bytes
+        """
+        self.check = check
+        self.decode = decode
+        self.reads = 0
+        self.hits = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, num_threads), thread_name_prefix="prefetch")
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _read(self, fname: str) -> Optional[bytes]:
+        """
+        Reads the file and checks it for completeness.
+
+        :param fname: the file to read
+        :type fname: str
+        :return: the content, None if incomplete
+        :rtype: bytes
+        """
+        with open(fname, "rb") as fp:
+            data = fp.read()
+        with self._lock:
+            self.reads += 1
+        if (self.check is not None) and not self.check(data):
+            return None
+        return data
+
+    def _decode(self, read):
+        """
+        Decodes the content once read. Returns the raw bytes if decoding fails, leaving the error to the inference.
+
+        :param read: the future of the read
+        :return: the decoded image, None if incomplete
+        """
+        data = read.result()
+        if data is None:
+            return None
+        try:
+            return self.decode(data)
+        except Exception:
+            return data
+
+    def prefetch(self, fnames: Iterable[str]):
+        """
+        Starts reading (and decoding) the files that are not pending yet.
+
+        :param fnames: the files to prefetch
+        :type fnames: iterable
+        """
+        with self._lock:
+            for fname in fnames:
+                if fname in self._pending:
+                    continue
+                read = self._executor.submit(self._read, fname)
+                decoded = self._executor.submit(self._decode, read) if self.decode is not None else None
+                self._pending[fname] = (read, decoded)
+
+    def retain(self, fnames: Iterable[str]):
+        """
+        Discards the pending files that are not in the list, e.g., ones that disappeared.
+
+        :param fnames: the files to keep
+        :type fnames: iterable
+        """
+        keep = set(fnames)
+        with self._lock:
+            for fname in [x for x in self._pending if x not in keep]:
+                del self._pending[fname]
+
+    def complete(self, fname: str) -> Optional[bool]:
+        """
+        Waits for the file to be read and returns whether it is complete. Incomplete files get discarded,
+        i.e., they get read again when prefetched the next time.
+
+        :param fname: the file to check
+        :type fname: str
+        :return: whether the file is complete, None if not pending
+        :rtype: bool
+        """
+        with self._lock:
+            entry = self._pending.get(fname)
+        if entry is None:
+            return None
+        try:
+            result = entry[0].result() is not None
+        except Exception:
+            result = False
+        if not result:
+            with self._lock:
+                self._pending.pop(fname, None)
+        return result
+
+    def take(self, fname: str):
+        """
+        Waits for the file to be read (and decoded) and removes it from the pending files.
+
+        :param fname: the file to retrieve
+        :type fname: str
+        :return: the content (raw bytes or decoded image), None if not pending or failed to read
+        """
+        with self._lock:
+            entry = self._pending.pop(fname, None)
+        if entry is None:
+            return None
+        try:
+            result = (entry[1] if entry[1] is not None else entry[0]).result()
+        except Exception:
+            return None
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def stats(self) -> str:
+        """
+        Returns the statistics of the prefetcher.
+
+        :return: the statistics
+        :rtype: str
+        """
+        return "pending: %d, reads: %d, hits: %d" % (len(self._pending), self.reads, self.hits)
+
+    def close(self):
+        """
+        Discards the pending files and shuts down the thread pool.
+        """
+        with self._lock:
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
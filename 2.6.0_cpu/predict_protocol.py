@@ -0,0 +1,117 @@
+import struct
+from typing import List, Tuple
+
+import numpy as np
+import orjson
+from ppcls.engine.custom_engine import PIXELS_MAGIC, is_error
+from predict_common import prediction_to_dict
+
+
+MESSAGE_FORMAT_SINGLE = "single"
+""" one image per message, one JSON object with the predictions per image. """
+
+MESSAGE_FORMAT_MULTI = "multi"
+""" multiple images plus request ID per message (see encode_images), one JSON object per message. """
+
+MESSAGE_FORMATS = [MESSAGE_FORMAT_SINGLE, MESSAGE_FORMAT_MULTI]
+""" the available message formats. """
+
+MULTI_MAGIC = b"PCMI"
+""" the magic bytes that the multi-image messages start with. """
+
+
+def encode_images(request_id: str, images: List[bytes]) -> bytes:
+    """
+    Generates a multi-image message: magic bytes, request ID (uint16 length + UTF-8), number of images (uint32)
+    and the images (uint32 length + bytes each); all integers little-endian.
+
+    :param request_id: the ID of the request
+    :type request_id: str
+    :param images: the images (raw bytes)
+    :type images: list
+    :return: the message
+    :rtype: bytes
+    """
+    rid = request_id.encode("utf-8")
+    parts = [MULTI_MAGIC, struct.pack("<H", len(rid)), rid, struct.pack("<I", len(images))]
+    for image in images:
+        parts.append(struct.pack("<I", len(image)))
+        parts.append(image)
+    return b"".join(parts)
+
+
+def decode_images(data: bytes) -> Tuple[str, List[bytes]]:
+    """
+    Parses a multi-image message.
+
+    :param data: the message to parse
+    :type data: bytes
+    :return: the request ID and the images
+    :rtype: tuple
+    """
+    if not data.startswith(MULTI_MAGIC):
+        raise Exception("Not a multi-image message (magic bytes: %s)" % str(data[:len(MULTI_MAGIC)]))
+    view = memoryview(data)
+    offset = len(MULTI_MAGIC)
+    length, = struct.unpack_from("<H", view, offset)
+    offset += 2
+    request_id = bytes(view[offset:offset + length]).decode("utf-8")
+    offset += length
+    count, = struct.unpack_from("<I", view, offset)
+    offset += 4
+    images = []
+    for i in range(count):
+        length, = struct.unpack_from("<I", view, offset)
+        offset += 4
+        if offset + length > len(data):
+            raise Exception("Image #%d of request '%s' truncated: %d > %d bytes" % (i, request_id, offset + length, len(data)))
+        images.append(bytes(view[offset:offset + length]))
+        offset += length
+    return request_id, images
+
+
+def encode_pixels(image: np.ndarray) -> bytes:
+    """
+    Generates a pixel payload from the decoded image, which the engine uses as is rather than decoding it
+    (see custom_engine.decode_pixels): magic bytes, data type code (uint8; 1=uint8), number of
+    dimensions (uint8), dimensions (uint32 each) and the pixels; all integers little-endian.
+
+    :param image: the image (uint8, RGB, HWC)
+    :type image: np.ndarray
+    :return: the payload
+    :rtype: bytes
+    """
+    if image.dtype != np.uint8:
+        raise Exception("Only uint8 images are supported, found: %s" % str(image.dtype))
+    if (image.ndim != 3) or (image.shape[2] != 3):
+        raise Exception("Image must have shape (height, width, 3), found: %s" % str(image.shape))
+    header = PIXELS_MAGIC + struct.pack("<BB3I", 1, image.ndim, *image.shape)
+    return header + np.ascontiguousarray(image).tobytes()
+
+
+def predictions_to_data(request_id: str, predictions: List, top_k: int = None, threshold: float = None,
+                        precision: int = None) -> bytes:
+    """
+    Turns the predictions for the images of a multi-image message into JSON bytes: the request ID ("id") and
+    the list of class probabilities or error message per image ("predictions").
+
+    :param request_id: the ID of the request
+    :type request_id: str
+    :param predictions: the paddleclas prediction objects, aligned with the images
+    :type predictions: list
+    :param top_k: the maximum number of classes (highest scores first) to output, all if None
+    :type top_k: int
+    :param threshold: the minimum score for classes to output, all if None
+    :type threshold: float
+    :param precision: the number of decimals to round the scores to, no rounding if None
+    :type precision: int
+    :return: the generated JSON
+    :rtype: bytes
+    """
+    result = []
+    for prediction in predictions:
+        if is_error(prediction):
+            result.append({"error": prediction["error"]})
+        else:
+            result.append(prediction_to_dict(prediction, top_k=top_k, threshold=threshold, precision=precision))
+    return orjson.dumps({"id": request_id, "predictions": result})
@@ -0,0 +1,107 @@
+import struct
+import time
+from datetime import datetime
+from typing import Tuple
+
+DEADLINE_MAGIC = b"PCDL"
+""" the magic bytes that messages with deadline start with. """
+
+DEADLINE_HEADER = struct.calcsize("<Bd")
+""" the size of the header following the magic bytes: kind and timestamp. """
+
+DEADLINE_ABSOLUTE = 1
+""" the timestamp is the deadline for the result. """
+
+DEADLINE_ENQUEUED = 2
+""" the timestamp is the time the message was enqueued, the maximum age determines the deadline. """
+
+EXPIRED_DROP = "drop"
+""" expired messages get dropped silently. """
+
+EXPIRED_FAIL = "fail"
+""" an error gets sent for expired messages. """
+
+EXPIRED_POLICIES = [EXPIRED_DROP, EXPIRED_FAIL]
+""" the available policies for expired messages. """
+
+DEADLINE_EXCEEDED = "Deadline exceeded"
+""" the error sent for expired messages (fail policy). """
+
+
+def encode_deadline(data: bytes, timestamp: float = None, kind: int = DEADLINE_ENQUEUED) -> bytes:
+    """
+    Wraps the message in an envelope with a timestamp: magic bytes, kind (uint8; 1=deadline, 2=enqueue time),
+    timestamp (float64, seconds since epoch), followed by the message; all little-endian.
+
+    :param data: the message to wrap
+    :type data: bytes
+    :param timestamp: the timestamp, uses the current time if None
+    :type timestamp: float
+    :param kind: the meaning of the timestamp, i.e., DEADLINE_ABSOLUTE or DEADLINE_ENQUEUED
+    :type kind: int
+    :return: the wrapped message
+    :rtype: bytes
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    return DEADLINE_MAGIC + struct.pack("<Bd", kind, timestamp) + data
+
+
+class LoadShedder(object):
+    """
+    Unwraps messages with deadline (see encode_deadline) and determines whether they have expired already,
+    counting the processed and expired messages.
+    """
+
+    def __init__(self, max_age_ms: float = None, expired: str = EXPIRED_DROP):
+        """
+        Initializes the shedder.
+
+        :param max_age_ms: the maximum age in milliseconds of messages (since enqueued, or received if no enqueue time available), no limit if None
+        :type max_age_ms: float
+        :param expired: how to handle expired messages (drop/fail)
+        :type expired: str
+        """
+        self.max_age = max_age_ms / 1000.0 if max_age_ms is not None else None
+        self.expired = expired
+        self.processed = 0
+        self.shed = 0
+
+    def unwrap(self, data: bytes, received: datetime = None) -> Tuple[bytes, bool]:
+        """
+        Unwraps the message (if it has a deadline) and checks whether it has expired.
+
+        :param data: the message
+        :type data: bytes
+        :param received: the time the message was received, None if just now
+        :type received: datetime
+        :return: the (unwrapped) message and whether it has expired
+        :rtype: tuple
+        """
+        now = time.time()
+        deadline = None
+        if isinstance(data, bytes) and data.startswith(DEADLINE_MAGIC):
+            if len(data) < len(DEADLINE_MAGIC) + DEADLINE_HEADER:
+                raise Exception("Deadline envelope truncated: %d < %d bytes" % (len(data), len(DEADLINE_MAGIC) + DEADLINE_HEADER))
+            kind, timestamp = struct.unpack_from("<Bd", data, len(DEADLINE_MAGIC))
+            data = data[len(DEADLINE_MAGIC) + DEADLINE_HEADER:]
+            if kind == DEADLINE_ABSOLUTE:
+                deadline = timestamp
+            elif self.max_age is not None:
+                deadline = timestamp + self.max_age
+        elif (received is not None) and (self.max_age is not None):
+            deadline = received.timestamp() + self.max_age
+        if (deadline is not None) and (now > deadline):
+            self.shed += 1
+            return data, True
+        self.processed += 1
+        return data, False
+
+    def stats(self) -> str:
+        """
+        Returns the counters.
+
+        :return: the counters
+        :rtype: str
+        """
+        return "processed: %d, expired: %d" % (self.processed, self.shed)
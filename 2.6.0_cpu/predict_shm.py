@@ -0,0 +1,128 @@
+import mmap
+import os
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+SHM_MAGIC = b"PCSM"
+""" the magic bytes that references to shared images start with. """
+
+REFERENCE_SHM = 1
+""" the image is located in a POSIX shared memory segment. """
+
+REFERENCE_FILE = 2
+""" the image is located in a (memory-mapped) file. """
+
+
+def is_reference(data) -> bool:
+    """
+    Checks whether the data is a reference to a shared image.
+
+    :param data: the data to check
+    :return: True if a reference
+    :rtype: bool
+    """
+    return isinstance(data, bytes) and data.startswith(SHM_MAGIC)
+
+
+def encode_reference(name: str, offset: int, length: int, kind: int = REFERENCE_SHM, release: bool = False) -> bytes:
+    """
+    Generates a reference to a shared image: magic bytes, kind (uint8; 1=shared memory, 2=file), release flag (uint8),
+    offset (uint64), length (uint64), length of the UTF-8 encoded name (uint16) and the name; all integers little-endian.
+
+    :param name: the name of the shared memory segment or the path of the file
+    :type name: str
+    :param offset: the offset of the image in bytes
+    :type offset: int
+    :param length: the length of the image in bytes
+    :type length: int
+    :param kind: the kind of reference, i.e., REFERENCE_SHM or REFERENCE_FILE
+    :type kind: int
+    :param release: whether to unlink the segment/delete the file after processing the image
+    :type release: bool
+    :return: the reference
+    :rtype: bytes
+    """
+    name = name.encode("utf-8")
+    return SHM_MAGIC + struct.pack("<BBQQH", kind, 1 if release else 0, offset, length, len(name)) + name
+
+
+class SharedImage(object):
+    """
+    Provides zero-copy access to an image in a POSIX shared memory segment or a memory-mapped file.
+    """
+
+    def __init__(self, reference: bytes, file_dir: str = None, shm_prefix: str = None):
+        """
+        Opens the referenced image.
+
+        :param reference: the reference to open (see encode_reference)
+        :type reference: bytes
+        :param file_dir: the directory that referenced files must be located in, files are not allowed if None
+        :type file_dir: str
+        :param shm_prefix: the prefix that the names of referenced segments must start with, segments are not allowed if None
+        :type shm_prefix: str
+        """
+        kind, release, offset, length, name_length = struct.unpack_from("<BBQQH", reference, len(SHM_MAGIC))
+        self.name = reference[len(SHM_MAGIC) + 20:len(SHM_MAGIC) + 20 + name_length].decode("utf-8")
+        self.kind = kind
+        self.release = release == 1
+        self._shm = None
+        self._mmap = None
+        if kind == REFERENCE_SHM:
+            if shm_prefix is None:
+                raise Exception("Shared memory references are not allowed!")
+            # the leading slash of POSIX names is optional
+            if not self.name.lstrip("/").startswith(shm_prefix):
+                raise Exception("Shared memory segment does not start with %s: %s" % (shm_prefix, self.name))
+            self._shm = SharedMemory(name=self.name)
+            # the segment is owned by the client, prevent the resource tracker from removing it on exit
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            buf = self._shm.buf
+        elif kind == REFERENCE_FILE:
+            if file_dir is None:
+                raise Exception("File references are not allowed!")
+            path = os.path.realpath(self.name)
+            if os.path.commonpath([path, os.path.realpath(file_dir)]) != os.path.realpath(file_dir):
+                raise Exception("File is not located in %s: %s" % (file_dir, self.name))
+            self.name = path
+            with open(path, "rb") as fp:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = memoryview(self._mmap)
+        else:
+            raise Exception("Unknown reference kind: %d" % kind)
+        if offset + length > len(buf):
+            size = len(buf)
+            buf.release()
+            self.close(release=False)
+            raise Exception("Image at %d+%d exceeds size of %s: %d" % (offset, length, self.name, size))
+        self.data = buf[offset:offset + length]
+        """ the image (memoryview). """
+        if self._mmap is not None:
+            buf.release()
+
+    def close(self, release: bool = None):
+        """
+        Closes the segment/file, unlinking/deleting it if requested by the reference.
+        The image data must no longer be in use.
+
+        :param release: overrides the release flag of the reference, if not None
+        :type release: bool
+        """
+        if release is None:
+            release = self.release
+        if getattr(self, "data", None) is not None:
+            self.data.release()
+            self.data = None
+        if self._shm is not None:
+            self._shm.close()
+            if release:
+                # unlink() unregisters the segment from the resource tracker again
+                resource_tracker.register(self._shm._name, "shared_memory")
+                self._shm.unlink()
+            self._shm = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            if release:
+                os.remove(self.name)
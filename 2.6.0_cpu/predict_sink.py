@@ -0,0 +1,474 @@
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+import orjson
+from predict_common import prediction_to_dict, prediction_to_list
+
+
+SINK_FILES = "files"
+""" one JSON file per image. """
+
+SINK_JSONL = "jsonl"
+""" rotating JSON lines files, one line per image. """
+
+SINK_PARQUET = "parquet"
+""" rotating Parquet files, one row per image. """
+
+SINK_ARROW = "arrow"
+""" rotating Arrow IPC files, one row per image. """
+
+SINKS = [SINK_FILES, SINK_JSONL, SINK_PARQUET, SINK_ARROW]
+""" the available output formats. """
+
+TMP_EXT = ".tmp"
+""" the extension of the files that are still being written. """
+
+RECOVER_AGE = 3600.0
+""" the time in seconds since the last modification after which a leftover .tmp file counts as abandoned (if there is no maximum file age). """
+
+
+class PredictionSink(object):
+    """
+    Appends the predictions to rotating files rather than writing one file per image. The rows get buffered
+    and written once the buffer is full or the flush interval has passed. A file gets finalized once it has
+    reached the maximum size or age (or when closing the sink): until then it carries the extension .tmp
+    (or resides in the temporary directory), i.e., readers only ever see complete files. The keys of the images in
+    a finalized file get handed to the on_finalize callback, e.g., for recording them as processed.
+    The .tmp files abandoned by a previous run (e.g., after a crash) can be finalized via recover().
+    """
+
+    extension = None
+    """ the extension of the output files. """
+
+    def __init__(self, output_dir: str, tmp_dir: str = None, prefix: str = "predictions",
+                 max_file_size: Optional[int] = 256 * 1024 * 1024, max_file_age: Optional[float] = 3600.0,
+                 flush_rows: int = 1000, flush_interval: Optional[float] = 10.0, output_options: dict = None,
+                 on_finalize: Callable[[List[str]], None] = None):
+        """
+        Initializes the sink.
+
+        :param output_dir: the directory to store the finalized files in
+        :type output_dir: str
+        :param tmp_dir: the directory for the files that are still being written, uses the output directory if None
+        :type tmp_dir: str
+        :param prefix: the prefix for the file names
+        :type prefix: str
+        :param max_file_size: the size in bytes after which to start a new file, no limit if None
+        :type max_file_size: int
+        :param max_file_age: the time in seconds after which to start a new file, no limit if None
+        :type max_file_age: float
+        :param flush_rows: the number of buffered rows that triggers writing them to the file
+        :type flush_rows: int
+        :param flush_interval: the maximum time in seconds to buffer rows, no limit if None
+        :type flush_interval: float
+        :param output_options: the keyword arguments for filtering the predictions (top_k, threshold, precision)
+        :type output_options: dict
+        :param on_finalize: the function to call with the keys of the images once their file got finalized
+        """
+        self.output_dir = output_dir
+        self.tmp_dir = tmp_dir
+        self.prefix = prefix
+        self.max_file_size = max_file_size if (max_file_size is not None) and (max_file_size > 0) else None
+        self.max_file_age = max_file_age if (max_file_age is not None) and (max_file_age > 0) else None
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval if (flush_interval is not None) and (flush_interval > 0) else None
+        self.output_options = output_options if output_options is not None else dict()
+        self.on_finalize = on_finalize
+        self.rows = 0
+        self.files = 0
+        self.recovered = 0
+        self.discarded = 0
+        self._buffer = []
+        self._buffer_keys = []
+        self._keys = []
+        self._path = None
+        self._tmp_path = None
+        self._opened = None
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if (self.flush_interval is not None) or (self.max_file_age is not None):
+            self._thread = threading.Thread(target=self._run, name="prediction-sink", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """
+        Writes the buffered rows/finalizes the file periodically, in case no further predictions arrive.
+        """
+        interval = min(x for x in [self.flush_interval, self.max_file_age, 1.0] if x is not None)
+        while not self._stopped.wait(interval):
+            with self._lock:
+                self._flush(force=False)
+
+    def _row(self, key: str, prediction):
+        """
+        Turns the prediction into a row.
+
+        :param key: the key of the image, e.g., its file name
+        :type key: str
+        :param prediction: the paddleclas prediction object
+        :return: the row
+        """
+        raise NotImplementedError()
+
+    def _open_file(self, path: str):
+        """
+        Opens the file for writing.
+
+        :param path: the file to open
+        :type path: str
+        """
+        raise NotImplementedError()
+
+    def _write_rows(self, rows: List):
+        """
+        Writes the rows to the open file.
+
+        :param rows: the rows to write
+        :type rows: list
+        """
+        raise NotImplementedError()
+
+    def _sync_file(self):
+        """
+        Forces the written rows of the open file to disk.
+        """
+        raise NotImplementedError()
+
+    def _close_file(self):
+        """
+        Closes the open file.
+        """
+        raise NotImplementedError()
+
+    def _recover_file(self, tmp_path: str, path: str) -> Optional[List[str]]:
+        """
+        Turns the rows of an abandoned file (i.e., up to the last complete write) into a complete file.
+
+        :param tmp_path: the abandoned file
+        :type tmp_path: str
+        :param path: the complete file to create
+        :type path: str
+        :return: the keys of the recovered rows, None if the file cannot be recovered or is empty
+        :rtype: list
+        """
+        raise NotImplementedError()
+
+    def _open(self):
+        """
+        Starts a new file.
+        """
+        name = "%s-%s-%d-%04d%s" % (self.prefix, datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid(),
+                                    self.files, self.extension)
+        self._path = os.path.join(self.output_dir, name)
+        self._tmp_path = os.path.join(self.tmp_dir if self.tmp_dir is not None else self.output_dir, name + TMP_EXT)
+        self._open_file(self._tmp_path)
+        self._opened = time.monotonic()
+        self.files += 1
+
+    def _finalize(self) -> Optional[str]:
+        """
+        Closes the current file and moves it to its final name.
+
+        :return: the finalized file, None if no file open
+        :rtype: str
+        """
+        if self._path is None:
+            return None
+        result = self._path
+        self._close_file()
+        shutil.move(self._tmp_path, self._path)
+        self._path = None
+        self._tmp_path = None
+        self._opened = None
+        keys = self._keys
+        self._keys = []
+        if self.on_finalize is not None:
+            self.on_finalize(keys)
+        return result
+
+    def _flush(self, force: bool = True):
+        """
+        Writes the buffered rows (if forced or due) and finalizes the file if it reached the maximum size or age.
+
+        :param force: whether to write the rows regardless of the flush interval
+        :type force: bool
+        """
+        now = time.monotonic()
+        due = force or ((self.flush_interval is not None) and (now - self._last_flush >= self.flush_interval))
+        if due and (len(self._buffer) > 0):
+            if self._path is None:
+                self._open()
+            self._write_rows(self._buffer)
+            self.rows += len(self._buffer)
+            self._buffer = []
+            if self.on_finalize is not None:
+                self._keys.extend(self._buffer_keys)
+            self._buffer_keys = []
+        if due:
+            self._last_flush = now
+        if self._path is not None:
+            if (self.max_file_size is not None) and (os.path.getsize(self._tmp_path) >= self.max_file_size):
+                self._finalize()
+            elif (self.max_file_age is not None) and (now - self._opened >= self.max_file_age):
+                self._finalize()
+
+    def write(self, key: str, prediction, manifest_key: str = None):
+        """
+        Adds the prediction.
+
+        :param key: the key of the image, e.g., its file name
+        :type key: str
+        :param prediction: the paddleclas prediction object
+        :param manifest_key: the key to hand to on_finalize instead of the key of the image, e.g., including the file's size/timestamp
+        :type manifest_key: str
+        """
+        row = self._row(key, prediction)
+        with self._lock:
+            self._buffer.append(row)
+            self._buffer_keys.append(manifest_key if manifest_key is not None else key)
+            if len(self._buffer) >= self.flush_rows:
+                self._flush()
+
+    def flush(self, sync: bool = False):
+        """
+        Writes the buffered rows to the current file.
+
+        :param sync: whether to force the rows to disk as well (fsync), e.g., before removing the inputs
+        :type sync: bool
+        """
+        with self._lock:
+            self._flush()
+            if sync and (self._path is not None):
+                self._sync_file()
+
+    def close(self):
+        """
+        Writes the buffered rows and finalizes the current file.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._flush()
+            self._finalize()
+
+    def recover(self) -> List[str]:
+        """
+        Finalizes the .tmp files with the prefix of this sink that were abandoned by a previous run, i.e., that have
+        not been modified for twice the maximum file age (or RECOVER_AGE). Empty files and ones that cannot be recovered
+        get removed.
+
+        :return: the keys of the recovered rows (image keys, not manifest keys)
+        :rtype: list
+        """
+        result = []
+        tmp_dir = self.tmp_dir if self.tmp_dir is not None else self.output_dir
+        max_age = 2 * self.max_file_age + 60 if self.max_file_age is not None else RECOVER_AGE
+        suffix = self.extension + TMP_EXT
+        now = time.time()
+        if not os.path.isdir(tmp_dir):
+            return result
+        with os.scandir(tmp_dir) as it:
+            entries = [x for x in it if x.name.startswith(self.prefix + "-") and x.name.endswith(suffix)]
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime < max_age:
+                    continue
+            except FileNotFoundError:
+                continue
+            keys = self._recover_file(entry.path, os.path.join(self.output_dir, entry.name[:-len(TMP_EXT)]))
+            if keys is None:
+                os.remove(entry.path)
+                self.discarded += 1
+            else:
+                result.extend(keys)
+                self.recovered += 1
+        return result
+
+    def stats(self) -> str:
+        """
+        Returns the statistics of the sink.
+
+        :return: the statistics
+        :rtype: str
+        """
+        result = "rows: %d, buffered: %d, files: %d" % (self.rows, len(self._buffer), self.files)
+        if self.recovered + self.discarded > 0:
+            result += ", recovered: %d, discarded: %d" % (self.recovered, self.discarded)
+        return result
+
+
+class JsonlSink(PredictionSink):
+    """
+    Writes one JSON object per line and image: the key ("image") and the class probabilities ("predictions").
+    """
+
+    extension = ".jsonl"
+
+    def __init__(self, *args, **kwargs):
+        self._fp = None
+        super().__init__(*args, **kwargs)
+
+    def _row(self, key: str, prediction):
+        return orjson.dumps({"image": key, "predictions": prediction_to_dict(prediction, **self.output_options)})
+
+    def _open_file(self, path: str):
+        self._fp = open(path, "wb")
+
+    def _write_rows(self, rows: List):
+        self._fp.write(b"\n".join(rows))
+        self._fp.write(b"\n")
+        self._fp.flush()
+
+    def _sync_file(self):
+        os.fsync(self._fp.fileno())
+
+    def _close_file(self):
+        self._fp.close()
+        self._fp = None
+
+    def _recover_file(self, tmp_path: str, path: str) -> Optional[List[str]]:
+        with open(tmp_path, "rb") as fp:
+            data = fp.read()
+        result = []
+        end = 0
+        # keeps the complete lines up to the first broken one, e.g., the last one being written during the crash
+        while True:
+            pos = data.find(b"\n", end)
+            if pos == -1:
+                break
+            try:
+                result.append(orjson.loads(data[end:pos])["image"])
+            except Exception:
+                break
+            end = pos + 1
+        if len(result) == 0:
+            return None
+        if end < len(data):
+            os.truncate(tmp_path, end)
+        shutil.move(tmp_path, path)
+        return result
+
+
+class ArrowSink(PredictionSink):
+    """
+    Writes one row per image with the columns: image (string), class_ids (list of int64),
+    label_names (list of string), scores (list of float32). Requires pyarrow.
+    """
+
+    extension = ".arrow"
+
+    def __init__(self, *args, **kwargs):
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("Output format %s requires pyarrow!" % self.extension[1:])
+        self._pa = pyarrow
+        self._fp = None
+        self._writer = None
+        self.schema = pyarrow.schema([
+            ("image", pyarrow.string()),
+            ("class_ids", pyarrow.list_(pyarrow.int64())),
+            ("label_names", pyarrow.list_(pyarrow.string())),
+            ("scores", pyarrow.list_(pyarrow.float32())),
+        ])
+        super().__init__(*args, **kwargs)
+
+    def _row(self, key: str, prediction):
+        return key, prediction_to_list(prediction, **self.output_options)
+
+    def _open_file(self, path: str):
+        import pyarrow.ipc
+        self._fp = open(path, "wb")
+        self._writer = pyarrow.ipc.new_file(self._fp, self.schema)
+
+    def _write_rows(self, rows: List):
+        table = self._pa.Table.from_pydict({
+            "image": [key for key, _ in rows],
+            "class_ids": [[x[0] for x in pred] for _, pred in rows],
+            "label_names": [[x[1] for x in pred] for _, pred in rows],
+            "scores": [[x[2] for x in pred] for _, pred in rows],
+        }, schema=self.schema)
+        self._writer.write_table(table)
+
+    def _sync_file(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def _close_file(self):
+        self._writer.close()
+        self._writer = None
+        self._fp.close()
+        self._fp = None
+
+    def _recover_file(self, tmp_path: str, path: str) -> Optional[List[str]]:
+        import pyarrow.ipc
+        with open(tmp_path, "rb") as fp:
+            data = fp.read()
+        # a file without footer is the magic (padded to 8 bytes) followed by the stream format
+        batches = []
+        try:
+            reader = pyarrow.ipc.open_stream(self._pa.py_buffer(data[8:]))
+            while True:
+                batches.append(reader.read_next_batch())
+        except StopIteration:
+            pass
+        except Exception:
+            pass
+        if len(batches) == 0:
+            return None
+        table = self._pa.Table.from_batches(batches, schema=self.schema)
+        recovered_path = tmp_path + ".recovered"
+        with pyarrow.ipc.new_file(recovered_path, self.schema) as writer:
+            writer.write_table(table)
+        os.replace(recovered_path, tmp_path)
+        shutil.move(tmp_path, path)
+        return table.column("image").to_pylist()
+
+
+class ParquetSink(ArrowSink):
+    """
+    Writes one row per image with the columns: image (string), class_ids (list of int64),
+    label_names (list of string), scores (list of float32); each flush becomes a row group. Requires pyarrow.
+    """
+
+    extension = ".parquet"
+
+    def _open_file(self, path: str):
+        import pyarrow.parquet
+        self._fp = open(path, "wb")
+        self._writer = pyarrow.parquet.ParquetWriter(self._fp, self.schema)
+
+    def _recover_file(self, tmp_path: str, path: str) -> Optional[List[str]]:
+        # the footer holding the metadata only gets written when closing the file
+        return None
+
+
+def create_sink(output_format: str, output_dir: str, **kwargs) -> Optional[PredictionSink]:
+    """
+    Creates the sink for the output format.
+
+    :param output_format: the output format, see SINKS
+    :type output_format: str
+    :param output_dir: the directory to store the files in
+    :type output_dir: str
+    :param kwargs: the other parameters for the sink
+    :return: the sink, None for one JSON file per image
+    :rtype: PredictionSink
+    """
+    if output_format == SINK_FILES:
+        return None
+    if output_format == SINK_JSONL:
+        return JsonlSink(output_dir, **kwargs)
+    if output_format == SINK_PARQUET:
+        return ParquetSink(output_dir, **kwargs)
+    if output_format == SINK_ARROW:
+        return ArrowSink(output_dir, **kwargs)
+    raise Exception("Unsupported output format: %s" % output_format)
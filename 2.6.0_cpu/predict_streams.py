@@ -0,0 +1,261 @@
+import os
+import socket
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+import redis
+from rdh import log
+
+
+def default_consumer() -> str:
+    """
+    Generates a consumer name from the host name and the process ID.
+
+    :return: the consumer name
+    :rtype: str
+    """
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+class StreamConsumer(object):
+    """
+    Reads the images from a Redis stream as part of a consumer group, so that multiple consumers split
+    the load. The results get appended to the output stream (fields: id of the input entry and either data
+    or error) and the input entries acknowledged in the same transaction, i.e., entries of consumers that
+    died before acknowledging them get reclaimed (at-least-once delivery).
+    """
+
+    def __init__(self, connection: redis.Redis, stream_in: str, stream_out: str, group: str, consumer: str,
+                 batch_size: int = 1, block_ms: int = 1000, claim_idle_ms: int = 60000,
+                 maxlen: Optional[int] = None, field: str = "data", max_deliveries: Optional[int] = 5):
+        """
+        Initializes the consumer.
+
+        :param connection: the redis connection to use
+        :type connection: redis.Redis
+        :param stream_in: the stream to read the images from
+        :type stream_in: str
+        :param stream_out: the stream to append the results to
+        :type stream_out: str
+        :param group: the name of the consumer group
+        :type group: str
+        :param consumer: the name of the consumer within the group
+        :type consumer: str
+        :param batch_size: the maximum number of entries to read at a time
+        :type batch_size: int
+        :param block_ms: the maximum time in milliseconds to wait for new entries
+        :type block_ms: int
+        :param claim_idle_ms: the time in milliseconds after which pending entries of other consumers get reclaimed
+        :type claim_idle_ms: int
+        :param maxlen: the (approximate) maximum length of the output stream, no trimming if None
+        :type maxlen: int
+        :param field: the field of the input entries containing the image
+        :type field: str
+        :param max_deliveries: the number of deliveries after which entries that still fail get an error appended to the output stream and acknowledged, no limit if None
+        :type max_deliveries: int
+        """
+        self.redis = connection
+        self.stream_in = stream_in
+        self.stream_out = stream_out
+        self.group = group
+        self.consumer = consumer
+        self.batch_size = max(1, batch_size)
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.maxlen = maxlen
+        self.field = field.encode()
+        self.max_deliveries = max_deliveries if (max_deliveries is not None) and (max_deliveries > 0) else None
+        self.stopped = False
+        self.claimed = 0
+        self.dead_lettered = 0
+        self._claim_start = "0-0"
+        self._last_claim = 0.0
+        self._history = True
+        self._history_start = "0"
+
+    def create_group(self):
+        """
+        Creates the consumer group (and the input stream) if necessary.
+        """
+        try:
+            self.redis.xgroup_create(self.stream_in, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _entries(self, entries: List) -> List[Tuple]:
+        """
+        Turns the stream entries into (entry ID, image) tuples, acknowledging entries without image right away.
+
+        :param entries: the (entry ID, fields) tuples
+        :type entries: list
+        :return: the (entry ID, image) tuples
+        :rtype: list
+        """
+        result = []
+        invalid = []
+        for entry_id, fields in entries:
+            if (fields is None) or (self.field not in fields):
+                invalid.append(entry_id)
+            else:
+                result.append((entry_id, fields[self.field]))
+        if len(invalid) > 0:
+            log("stream-consumer - acknowledging %d entries without field '%s'" % (len(invalid), self.field.decode()))
+            self.redis.xack(self.stream_in, self.group, *invalid)
+        return result
+
+    def _check_deliveries(self, entries: List[Tuple]) -> List[Tuple]:
+        """
+        Removes the entries that have been delivered more often than allowed (i.e., that keep failing),
+        appending an error for them to the output stream and acknowledging them.
+
+        :param entries: the (entry ID, image) tuples of entries that got delivered before
+        :type entries: list
+        :return: the remaining (entry ID, image) tuples
+        :rtype: list
+        """
+        if (self.max_deliveries is None) or (len(entries) == 0):
+            return entries
+        result = []
+        dead = []
+        # the entries are in ID order and owned by this consumer, i.e., a single query covers them
+        pending = self.redis.xpending_range(self.stream_in, self.group, min=entries[0][0], max=entries[-1][0],
+                                            count=len(entries), consumername=self.consumer)
+        deliveries = {x["message_id"]: x["times_delivered"] for x in pending}
+        for entry in entries:
+            if deliveries.get(entry[0], 0) > self.max_deliveries:
+                dead.append(entry[0])
+            else:
+                result.append(entry)
+        if len(dead) > 0:
+            log("stream-consumer - giving up on %d entries after %d deliveries" % (len(dead), self.max_deliveries))
+            self.dead_lettered += len(dead)
+            error = {"error": "Failed to process entry %d times" % self.max_deliveries}
+            self.complete(dead, [error] * len(dead))
+        return result
+
+    def claim(self) -> List[Tuple]:
+        """
+        Reclaims entries that other consumers have not acknowledged within the idle time.
+
+        :return: the (entry ID, image) tuples
+        :rtype: list
+        """
+        response = self.redis.xautoclaim(self.stream_in, self.group, self.consumer, self.claim_idle_ms,
+                                         start_id=self._claim_start, count=self.batch_size)
+        self._claim_start = response[0]
+        if len(response) > 2 and len(response[2]) > 0:
+            # entries that were trimmed from the stream
+            self.redis.xack(self.stream_in, self.group, *response[2])
+        if len(response[1]) > 0:
+            self.claimed += len(response[1])
+            log("stream-consumer - reclaimed %d pending entries" % len(response[1]))
+        return self._check_deliveries(self._entries(response[1]))
+
+    def read(self) -> List[Tuple]:
+        """
+        Reads the next batch of entries: first the ones already delivered to this consumer but not acknowledged
+        (e.g., before a restart; each of them once, failing ones only get retried via reclaiming), then
+        reclaimed ones and finally new ones.
+
+        :return: the (entry ID, image) tuples
+        :rtype: list
+        """
+        if self._history:
+            response = self.redis.xreadgroup(self.group, self.consumer, {self.stream_in: self._history_start},
+                                             count=self.batch_size)
+            entries = response[0][1] if len(response) > 0 else []
+            if len(entries) > 0:
+                self._history_start = entries[-1][0]
+                return self._check_deliveries(self._entries(entries))
+            self._history = False
+        if time.monotonic() - self._last_claim >= self.claim_idle_ms / 2000.0:
+            entries = self.claim()
+            if self._claim_start in (b"0-0", "0-0"):
+                self._last_claim = time.monotonic()
+            if len(entries) > 0:
+                return entries
+        response = self.redis.xreadgroup(self.group, self.consumer, {self.stream_in: ">"}, count=self.batch_size,
+                                         block=self.block_ms)
+        if len(response) == 0:
+            return []
+        return self._entries(response[0][1])
+
+    def complete(self, entry_ids: List, results: List[Dict]):
+        """
+        Appends the results to the output stream and acknowledges the input entries, in a single transaction.
+
+        :param entry_ids: the IDs of the input entries
+        :type entry_ids: list
+        :param results: the fields for the output entries (aligned with the IDs), None to only acknowledge the entry
+        :type results: list
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        for entry_id, fields in zip(entry_ids, results):
+            if fields is None:
+                continue
+            fields = dict(fields)
+            fields["id"] = entry_id
+            pipe.xadd(self.stream_out, fields, maxlen=self.maxlen, approximate=True)
+        pipe.xack(self.stream_in, self.group, *entry_ids)
+        pipe.execute()
+
+    def _process(self, process: Callable[[List], List[Dict]], entries: List[Tuple]):
+        """
+        Processes the entries and completes them.
+
+        :param process: the function that turns the list of images into the list of output fields
+        :param entries: the (entry ID, image) tuples to process
+        :type entries: list
+        """
+        results = process([x[1] for x in entries])
+        self.complete([x[0] for x in entries], results)
+
+    def _process_individually(self, process: Callable[[List], List[Dict]], entries: List[Tuple]):
+        """
+        Processes the entries one at a time after the batch failed, so that only the culprit stays pending
+        (and gets reclaimed after the idle time, until it reaches the maximum number of deliveries).
+
+        :param process: the function that turns the list of images into the list of output fields
+        :param entries: the (entry ID, image) tuples to process
+        :type entries: list
+        """
+        for entry in entries:
+            try:
+                self._process(process, [entry])
+            except redis.ConnectionError:
+                raise
+            except Exception:
+                log("stream-consumer - failed to process entry %s: %s" % (str(entry[0]), traceback.format_exc()))
+
+    def run(self, process: Callable[[List], List[Dict]]):
+        """
+        Processes the entries until stopped.
+
+        :param process: the function that turns the list of images into the list of output fields
+        """
+        self.create_group()
+        log("stream-consumer - consuming '%s' as '%s' in group '%s'" % (self.stream_in, self.consumer, self.group))
+        while not self.stopped:
+            try:
+                entries = self.read()
+                if len(entries) == 0:
+                    continue
+                try:
+                    self._process(process, entries)
+                except redis.ConnectionError:
+                    raise
+                except Exception:
+                    if len(entries) == 1:
+                        raise
+                    log("stream-consumer - failed to process batch of %d entries, retrying individually: %s" % (len(entries), traceback.format_exc()))
+                    self._process_individually(process, entries)
+            except KeyboardInterrupt:
+                self.stopped = True
+            except redis.ConnectionError:
+                log("stream-consumer - connection error: %s" % traceback.format_exc())
+                time.sleep(1.0)
+            except Exception:
+                # the entries stay pending and get reclaimed after the idle time
+                log("stream-consumer - failed to process entries: %s" % traceback.format_exc())
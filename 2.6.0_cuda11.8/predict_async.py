@@ -0,0 +1,184 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, List
+
+import redis.asyncio
+from rdh import log, get_password
+from predict_batching import OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST
+
+
+class AsyncReceiver(object):
+    """
+    Receives the messages with an asyncio redis client into a bounded queue, while the batches collected
+    from the queue get processed in a separate inference thread and the outputs get published through a
+    pipelined client. Receiving, inference and publishing therefore overlap rather than taking turns.
+    """
+
+    def __init__(self, ns, process_batch: Callable[[List], List], max_batch_size: int, max_wait_ms: float,
+                 max_queue_size: int = 0, overflow: str = OVERFLOW_BLOCK, max_pending_batches: int = 2):
+        """
+        Initializes the receiver.
+
+        :param ns: the parsed command-line arguments with the redis options (see rdh.create_parser)
+        :type ns: argparse.Namespace
+        :param process_batch: the function to call in the inference thread with the list of (message, time received) tuples, returns the list of outputs to publish
+        :param max_batch_size: the maximum number of messages per batch
+        :type max_batch_size: int
+        :param max_wait_ms: the maximum time in milliseconds to wait for further messages before processing the batch
+        :type max_wait_ms: float
+        :param max_queue_size: the maximum number of messages waiting in the queue, unbounded if <= 0
+        :type max_queue_size: int
+        :param overflow: the policy for adding messages to a full queue (block/drop_oldest/drop_newest)
+        :type overflow: str
+        :param max_pending_batches: the maximum number of batches waiting to be published, the inference waits once reached
+        :type max_pending_batches: int
+        """
+        self.ns = ns
+        self.channel_in = ns.redis_in
+        self.channel_out = ns.redis_out
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+        self.max_queue_size = max(0, max_queue_size)
+        self.overflow = overflow
+        self.max_pending_batches = max(1, max_pending_batches)
+        self.verbose = False
+        self.dropped = 0
+        self.published = 0
+        self.queue = None
+        self.outputs = None
+
+    async def put(self, item):
+        """
+        Adds the item to the queue, applying the overflow policy if the queue is full.
+
+        :param item: the item to add
+        """
+        if self.overflow == OVERFLOW_BLOCK:
+            await self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+            return
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                return
+        self.queue.get_nowait()
+        self.queue.put_nowait(item)
+
+    async def next_batch(self) -> List:
+        """
+        Collects the next batch, waiting for the first item.
+
+        :return: the collected items
+        :rtype: list
+        """
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            try:
+                if remaining > 0:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+        return batch
+
+    async def receive(self, client):
+        """
+        Subscribes to the input channel and adds the incoming messages to the queue.
+
+        :param client: the redis client to use
+        :type client: redis.asyncio.Redis
+        """
+        pubsub = client.pubsub()
+        await pubsub.psubscribe(self.channel_in)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                await self.put((message["data"], datetime.now()))
+        finally:
+            await pubsub.aclose()
+
+    async def infer(self, executor):
+        """
+        Hands the batches to the inference thread and queues their outputs for publishing, waiting
+        if too many batches are still waiting to be published.
+
+        :param executor: the executor with the inference thread
+        :type executor: ThreadPoolExecutor
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                outputs = await loop.run_in_executor(executor, self.process_batch, batch)
+            except Exception:
+                log("async - failed to process batch of %d message(s): %s" % (len(batch), traceback.format_exc()))
+                continue
+            if len(outputs) > 0:
+                await self.outputs.put(outputs)
+
+    async def publish(self, client):
+        """
+        Publishes the queued outputs, sending all the outputs that are available at a time in a single round-trip.
+
+        :param client: the redis client to use
+        :type client: redis.asyncio.Redis
+        """
+        while True:
+            pending = [await self.outputs.get()]
+            while not self.outputs.empty():
+                pending.append(self.outputs.get_nowait())
+            try:
+                async with client.pipeline(transaction=False) as pipe:
+                    for outputs in pending:
+                        for output in outputs:
+                            pipe.publish(self.channel_out, output)
+                    results = await pipe.execute()
+                self.published += len(results)
+                if self.verbose:
+                    log("async - %d prediction(s) published: %s" % (len(results), self.channel_out))
+            except Exception:
+                log("async - failed to publish %d prediction(s): %s" % (sum(len(x) for x in pending), traceback.format_exc()))
+
+    async def main(self):
+        """
+        Runs the receiving, inference and publishing tasks until one of them fails.
+        """
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self.outputs = asyncio.Queue(self.max_pending_batches)
+        client = redis.asyncio.Redis(host=self.ns.redis_host, port=self.ns.redis_port, db=self.ns.redis_db,
+                                     password=get_password(self.ns))
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        tasks = [
+            asyncio.create_task(self.receive(client)),
+            asyncio.create_task(self.infer(executor)),
+            asyncio.create_task(self.publish(client)),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=True)
+            await client.aclose()
+
+    def run(self):
+        """
+        Runs the receiver in the current thread until interrupted.
+        """
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,373 @@
+import argparse
+import os
+import tarfile
+import time
+import traceback
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from ppcls.engine.custom_engine import is_error
+from predict_backends import BACKENDS, BACKEND_DYGRAPH, PRECISIONS, PRECISION_FP32
+from predict_common import load_model, report_stats
+from predict_manifest import Manifest, STATUS_FAILED, in_shard
+from predict_sink import SINKS, SINK_FILES, SINK_JSONL, create_sink
+
+
+SUPPORTED_EXTS = [".jpg", ".jpeg", ".png", ".bmp"]
+""" supported file extensions (lower case). """
+
+OUTPUT_FORMATS = [x for x in SINKS if x != SINK_FILES]
+""" the available output formats. """
+
+
+def is_image(name: str) -> bool:
+    """
+    Checks whether the file name has one of the supported extensions.
+
+    :param name: the file name to check
+    :type name: str
+    :return: True if supported
+    :rtype: bool
+    """
+    return os.path.splitext(name)[1].lower() in SUPPORTED_EXTS
+
+
+def scan_dir(path: str) -> Iterator[str]:
+    """
+    Lists the images in the directory tree, sorted per directory.
+
+    :param path: the directory to scan
+    :type path: str
+    :return: the image files
+    """
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda x: x.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from scan_dir(entry.path)
+        elif is_image(entry.name):
+            yield entry.path
+
+
+def read_list(path: str) -> Iterator[str]:
+    """
+    Reads the image files from the text file (one per line, relative paths are relative to the file's directory).
+
+    :param path: the text file to read
+    :type path: str
+    :return: the image files
+    """
+    root = os.path.dirname(path)
+    with open(path, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) > 0:
+                yield os.path.join(root, line)
+
+
+def read_files(paths: Iterable[str], num_threads: int = 4, window: int = 64) -> Iterator[Tuple[str, bytes]]:
+    """
+    Reads the files in a thread pool, keeping up to window reads in flight. Files that fail to read get skipped.
+
+    :param paths: the files to read
+    :type paths: iterable
+    :param num_threads: the number of threads for reading
+    :type num_threads: int
+    :param window: the maximum number of files to read ahead
+    :type window: int
+    :return: the (file, content) tuples, in the order of the files
+    """
+    def read(path):
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def result(path, future):
+        try:
+            return path, future.result()
+        except Exception:
+            print("Failed to read image: %s\n%s" % (path, traceback.format_exc()))
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads), thread_name_prefix="read") as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(read, path)))
+            if len(pending) >= window:
+                path, data = result(*pending.popleft())
+                if data is not None:
+                    yield path, data
+        while len(pending) > 0:
+            path, data = result(*pending.popleft())
+            if data is not None:
+                yield path, data
+
+
+def read_tar(path: str, select: Callable[[str], bool] = None) -> Iterator[Tuple[str, bytes]]:
+    """
+    Reads the images from the (optionally compressed) tar archive sequentially, without extracting it.
+
+    :param path: the archive to read
+    :type path: str
+    :param select: the function for checking whether to read the image with the key, reads all if None
+    :return: the (archive/member, content) tuples
+    """
+    with tarfile.open(path, "r|*") as tar:
+        for member in tar:
+            if member.isfile() and is_image(member.name):
+                key = os.path.join(path, member.name)
+                if (select is None) or select(key):
+                    yield key, tar.extractfile(member).read()
+
+
+def read_zip(path: str, select: Callable[[str], bool] = None) -> Iterator[Tuple[str, bytes]]:
+    """
+    Reads the images from the zip archive, without extracting it.
+
+    :param path: the archive to read
+    :type path: str
+    :param select: the function for checking whether to read the image with the key, reads all if None
+    :return: the (archive/member, content) tuples
+    """
+    with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+            if (not info.is_dir()) and is_image(info.filename):
+                key = os.path.join(path, info.filename)
+                if (select is None) or select(key):
+                    yield key, z.read(info)
+
+
+def read_images(inputs: List[str], file_lists: List[str] = None, num_threads: int = 4,
+                select: Callable[[str], bool] = None) -> Iterator[Tuple[str, bytes]]:
+    """
+    Reads the images from the inputs: directories (recursively), tar/zip archives or image files,
+    plus the images listed in the text files.
+
+    :param inputs: the directories, archives and images to read
+    :type inputs: list
+    :param file_lists: the text files with the images to read (one per line)
+    :type file_lists: list
+    :param num_threads: the number of threads for reading image files
+    :type num_threads: int
+    :param select: the function for checking whether to read the image with the key (before reading it), reads all if None
+    :return: the (key, content) tuples
+    """
+    def selected(paths):
+        return paths if select is None else filter(select, paths)
+
+    for path in inputs:
+        if os.path.isdir(path):
+            yield from read_files(selected(scan_dir(path)), num_threads=num_threads)
+        elif is_image(path):
+            yield from read_files(selected([path]), num_threads=1)
+        elif zipfile.is_zipfile(path):
+            yield from read_zip(path, select=select)
+        elif tarfile.is_tarfile(path):
+            yield from read_tar(path, select=select)
+        else:
+            raise Exception("Unsupported input (neither directory, archive nor image): %s" % path)
+    if file_lists is not None:
+        for path in file_lists:
+            yield from read_files(selected(read_list(path)), num_threads=num_threads)
+
+
+class Progress(object):
+    """
+    Counts the processed images and outputs the throughput periodically.
+    """
+
+    def __init__(self, interval: float = 10.0):
+        """
+        Initializes the progress.
+
+        :param interval: the interval in seconds for outputting the throughput, never if <= 0
+        :type interval: float
+        """
+        self.interval = interval
+        self.count = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self._last = self.start
+        self._last_count = 0
+
+    def update(self, success: bool = True):
+        """
+        Counts the image and outputs the throughput if the interval has passed.
+
+        :param success: whether the image was processed successfully
+        :type success: bool
+        """
+        self.count += 1
+        if not success:
+            self.failed += 1
+        if self.interval > 0:
+            now = time.monotonic()
+            if now - self._last >= self.interval:
+                print("%d image(s) processed (%d failed): %.1f images/sec (overall: %.1f images/sec)"
+                      % (self.count, self.failed, (self.count - self._last_count) / (now - self._last),
+                         self.count / (now - self.start)))
+                self._last = now
+                self._last_count = self.count
+
+    def summary(self) -> str:
+        """
+        Returns the overall throughput.
+
+        :return: the summary
+        :rtype: str
+        """
+        elapsed = time.monotonic() - self.start
+        return "%d image(s) processed (%d failed) in %.1f sec: %.1f images/sec" \
+               % (self.count, self.failed, elapsed, self.count / elapsed if elapsed > 0 else 0.0)
+
+
+def predict_bulk(engine, items: Iterable[Tuple[str, bytes]], sink, batch_size: int = None,
+                 progress_interval: float = 10.0, manifest: Manifest = None) -> Progress:
+    """
+    Runs the images through the engine in full batches and appends the predictions to the sink.
+
+    :param engine: the CustomEngine to use
+    :type engine: CustomEngine
+    :param items: the (key, content) tuples of the images
+    :type items: iterable
+    :param sink: the sink to append the predictions to
+    :type sink: PredictionSink
+    :param batch_size: the number of images per batch, uses Infer.batch_size from the config if None
+    :type batch_size: int
+    :param progress_interval: the interval in seconds for outputting the throughput, never if <= 0
+    :type progress_interval: float
+    :param manifest: the manifest to record the failed images in (the sink records the successful ones), ignored if None
+    :type manifest: Manifest
+    :return: the progress
+    :rtype: Progress
+    """
+    progress = Progress(interval=progress_interval)
+    for key, pred in engine.infer_stream(items, batch_size=batch_size):
+        if is_error(pred):
+            print("Failed to process image: %s\n%s" % (key, pred["error"]))
+            if manifest is not None:
+                manifest.mark([key], STATUS_FAILED)
+            progress.update(False)
+            continue
+        sink.write(key, pred)
+        progress.update()
+    return progress
+
+
+def main(args=None):
+    """
+    Performs the bulk prediction.
+    Use -h to see all options.
+
+    :param args: the command-line arguments to use, uses sys.argv if None
+    :type args: list
+    """
+    parser = argparse.ArgumentParser(
+        description='PaddleClas - Bulk prediction of images in directories, file lists and tar/zip archives (without extracting them), writing the predictions to aggregated output files',
+        prog="paddleclas_predict_bulk",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', help='Path to the config file', required=True, default=None)
+    parser.add_argument('--model_path', help='Path to the trained model (.pdparams file), overrides config file', required=False, default=None)
+    parser.add_argument('--class_id_map_file', help='Path to the file with the class index/label mapping, overrides config file', required=False, default=None)
+    parser.add_argument('--device', help='The device to use', default="gpu")
+    parser.add_argument('--backend', choices=BACKENDS, help='The backend for running the model; inference/onnx convert the model once (next to the .pdparams file) and use the Paddle Inference predictor/ONNX Runtime', required=False, default=BACKEND_DYGRAPH)
+    parser.add_argument('--precision', choices=PRECISIONS, help='The precision of the model for the inference backend; int8 requires the model generated by paddleclas_quantize', required=False, default=PRECISION_FP32)
+    parser.add_argument('--num_threads', type=int, help='The number of CPU threads for the inference backend (uses all cores if not specified) or the intra-op threads for the onnx backend', required=False, default=None)
+    parser.add_argument('--inter_op_threads', type=int, help='The number of inter-op threads for the onnx backend', required=False, default=None)
+    parser.add_argument('--num_workers', type=int, help='The number of threads for decoding/preprocessing the next batch while the model runs on the current one, 0 for serial preprocessing', required=False, default=4)
+    parser.add_argument('--vectorized_preprocess', action='store_true', help='Whether to decode/resize/crop each image into a preallocated batch buffer and normalize the whole batch at once (requires the Infer transforms DecodeImage/ResizeImage/CropImage, NormalizeImage, ToCHWImage)', required=False, default=False)
+    parser.add_argument('--reduced_decode', action='store_true', help='Whether to decode JPEGs at a reduced scale (1/2, 1/4, 1/8) if they are still at least as large as the ResizeImage target', required=False, default=False)
+    parser.add_argument('--input', nargs="*", help='The directories (scanned recursively), tar/zip archives and images to process', required=False, default=None)
+    parser.add_argument('--file_list', nargs="*", help='The text files with the images to process (one per line, relative paths are relative to the text file)', required=False, default=None)
+    parser.add_argument('--read_threads', type=int, help='The number of threads for reading image files (directories, file lists)', required=False, default=4)
+    parser.add_argument('--batch_size', type=int, help='The number of images per inference call, uses Infer.batch_size from the config if not specified', required=False, default=None)
+    parser.add_argument('--output_dir', help='The directory to write the output files to', required=True, default=None)
+    parser.add_argument('--output_tmp', help='The directory for the output files that are still being written, uses --output_dir if not specified', required=False, default=None)
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, help='The format of the output files (one line/row per image)', required=False, default=SINK_JSONL)
+    parser.add_argument('--output_prefix', help='The prefix for the names of the output files', required=False, default="predictions")
+    parser.add_argument('--output_max_size', type=float, help='The size in MB after which to start a new output file, no limit if <= 0; with a manifest, the images only count as processed once their output file is complete', required=False, default=256.0)
+    parser.add_argument('--output_max_age', type=float, help='The time in seconds after which to start a new output file, no limit if <= 0; bounds the time until the images of an output file get recorded in the manifest', required=False, default=300.0)
+    parser.add_argument('--output_flush_rows', type=int, help='The number of buffered predictions that triggers writing them to the output file', required=False, default=10000)
+    parser.add_argument('--manifest', help='The SQLite database for recording the processed images (keys and model fingerprint), for skipping them when re-running after an interruption; can be shared by processes handling different shards', required=False, default=None)
+    parser.add_argument('--retry_failed', action='store_true', help='Whether to process images again that failed according to the manifest', required=False, default=False)
+    parser.add_argument('--num_shards', type=int, help='The number of shards to split the images into (via the CRC32 of their keys), for distributing them across processes', required=False, default=1)
+    parser.add_argument('--shard_index', type=int, help='The 0-based index of the shard to process', required=False, default=0)
+    parser.add_argument('--progress_interval', type=float, help='The interval in seconds for outputting the throughput (images/sec), never if <= 0', required=False, default=10.0)
+    parser.add_argument('--top_k', type=int, help='The maximum number of classes (highest scores first) to output, all if not specified', required=False, default=None)
+    parser.add_argument('--score_threshold', type=float, help='The minimum score for classes to output, all if not specified', required=False, default=None)
+    parser.add_argument('--score_precision', type=int, help='The number of decimals to round the scores to, no rounding if not specified', required=False, default=None)
+    parser.add_argument('--collect_stats', action='store_true', help='Whether to record the latencies of the inference stages (decode, preprocessing operators, to_tensor, forward, postprocess) and the batch sizes', required=False, default=False)
+    parser.add_argument('--stats_interval', type=float, help='The interval in seconds for outputting the statistics, only on shutdown if <= 0', required=False, default=60.0)
+    parser.add_argument('--stats_file', help='The JSON file to save the statistics to as well', required=False, default=None)
+    parsed = parser.parse_args(args=args)
+
+    if (parsed.input is None) and (parsed.file_list is None):
+        raise Exception("No inputs (--input) or file lists (--file_list) specified!")
+    if (parsed.shard_index < 0) or (parsed.shard_index >= max(1, parsed.num_shards)):
+        raise Exception("Shard index must be within [0, %d): %d" % (max(1, parsed.num_shards), parsed.shard_index))
+
+    engine = load_model(parsed.config, model_path=parsed.model_path,
+                        class_id_map_file=parsed.class_id_map_file,
+                        num_workers=parsed.num_workers, backend=parsed.backend,
+                        num_threads=parsed.num_threads, inter_op_threads=parsed.inter_op_threads,
+                        precision=parsed.precision, collect_stats=parsed.collect_stats,
+                        vectorized=parsed.vectorized_preprocess, reduced_decode=parsed.reduced_decode,
+                        device=parsed.device)
+    if parsed.collect_stats:
+        report_stats(engine, print, interval=parsed.stats_interval, path=parsed.stats_file)
+
+    manifest = Manifest(parsed.manifest, engine.fingerprint) if parsed.manifest is not None else None
+
+    def select(key):
+        if not in_shard(key, parsed.shard_index, parsed.num_shards):
+            return False
+        return (manifest is None) or not manifest.is_processed(key, retry_failed=parsed.retry_failed)
+
+    sink = create_sink(parsed.output_format, parsed.output_dir, tmp_dir=parsed.output_tmp,
+                       prefix=parsed.output_prefix, max_file_size=int(parsed.output_max_size * 1024 * 1024),
+                       max_file_age=parsed.output_max_age, flush_rows=parsed.output_flush_rows, flush_interval=None,
+                       output_options=dict(top_k=parsed.top_k, threshold=parsed.score_threshold,
+                                           precision=parsed.score_precision),
+                       on_finalize=manifest.mark if manifest is not None else None)
+    try:
+        # output files abandoned by an interrupted run
+        keys = sink.recover()
+        if sink.recovered + sink.discarded > 0:
+            print("Recovered %d predictions from %d abandoned output file(s), discarded %d" % (len(keys), sink.recovered, sink.discarded))
+        if manifest is not None:
+            manifest.mark(keys)
+        items = read_images(parsed.input if parsed.input is not None else [], file_lists=parsed.file_list,
+                            num_threads=parsed.read_threads, select=select)
+        progress = predict_bulk(engine, items, sink, batch_size=parsed.batch_size,
+                                progress_interval=parsed.progress_interval, manifest=manifest)
+        print(progress.summary())
+    finally:
+        sink.close()
+        if manifest is not None:
+            print("Manifest - %s" % manifest.stats())
+            manifest.close()
+
+
+def sys_main():
+    """
+    Runs the main function using the system cli arguments, and
+    returns a system error code.
+
+    :return: 0 for success, 1 for failure.
+    :rtype: int
+    """
+
+    try:
+        main()
+        return 0
+    except Exception:
+        print(traceback.format_exc())
+        return 1
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        print(traceback.format_exc())
@@ -0,0 +1,207 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+from ppcls.engine.custom_engine import is_error
+
+
+def estimate_size(obj) -> int:
+    """
+    Estimates the memory used by the (JSON-like) object in bytes.
+
+    :param obj: the object to estimate the size for
+    :return: the estimated size
+    :rtype: int
+    """
+    result = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            result += estimate_size(k) + estimate_size(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            result += estimate_size(v)
+    return result
+
+
+class PredictionCache(object):
+    """
+    LRU cache for predictions, keyed by a hash of the raw image bytes and the model identity.
+    """
+
+    def __init__(self, model_id: str, max_entries: int = 10000, max_memory: Optional[int] = None):
+        """
+        Initializes the cache.
+
+        :param model_id: the identity of the model (e.g., its fingerprint), becomes part of the keys
+        :type model_id: str
+        :param max_entries: the maximum number of predictions to cache
+        :type max_entries: int
+        :param max_memory: the maximum (estimated) memory in bytes to use for the predictions, no limit if None
+        :type max_memory: int
+        """
+        self.model_id = hashlib.blake2b(model_id.encode(), digest_size=32).digest()
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, data: bytes) -> bytes:
+        """
+        Generates the key for the raw image bytes (or the decoded image, including its shape and data type).
+
+        :param data: the raw image bytes
+        :type data: bytes
+        :return: the key
+        :rtype: bytes
+        """
+        result = hashlib.blake2b(digest_size=16, key=self.model_id)
+        if isinstance(data, np.ndarray):
+            result.update(("%s%s" % (data.dtype.str, str(data.shape))).encode())
+            data = np.ascontiguousarray(data)
+        result.update(data)
+        return result.digest()
+
+    def get(self, key: bytes):
+        """
+        Returns the cached prediction, marking it as most recently used.
+
+        :param key: the key of the prediction
+        :type key: bytes
+        :return: the prediction, None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: bytes, prediction):
+        """
+        Adds the prediction to the cache, evicting the least recently used ones if necessary.
+
+        :param key: the key of the prediction
+        :type key: bytes
+        :param prediction: the prediction to cache
+        """
+        size = estimate_size(prediction) + len(key)
+        with self._lock:
+            if key in self._entries:
+                self.memory -= self._entries.pop(key)[1]
+            self._entries[key] = (prediction, size)
+            self.memory += size
+            while (len(self._entries) > self.max_entries) \
+                    or ((self.max_memory is not None) and (self.memory > self.max_memory) and (len(self._entries) > 1)):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.memory -= evicted
+                self.evictions += 1
+
+    def stats(self) -> str:
+        """
+        Returns the statistics of the cache.
+
+        :return: the statistics
+        :rtype: str
+        """
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100.0 if total > 0 else 0.0
+        return "entries: %d, memory: %.1f MB, hits: %d, misses: %d (%.1f%% hit ratio), evictions: %d" \
+               % (len(self._entries), self.memory / 1024 / 1024, self.hits, self.misses, ratio, self.evictions)
+
+
+class CachedEngine(object):
+    """
+    Wraps a CustomEngine, only running inference for images not already in the cache.
+    Cached predictions skip preprocessing and inference entirely.
+    """
+
+    def __init__(self, engine, cache: PredictionCache):
+        """
+        Initializes the wrapper.
+
+        :param engine: the engine to wrap
+        :type engine: CustomEngine
+        :param cache: the cache to use
+        :type cache: PredictionCache
+        """
+        self.engine = engine
+        self.cache = cache
+
+    def __getattr__(self, item):
+        return getattr(self.engine, item)
+
+    def infer_raw(self, images: List) -> List:
+        """
+        Runs inferences on the incoming images that are not cached yet.
+
+        :param images: the list of images to run inference on (images are in raw bytes)
+        :type images: list
+        :return: the list of results, aligned with the images
+        """
+        keys = [self.cache.key(image) for image in images]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) == 0:
+            return results
+        preds = self.engine.infer_raw([images[i] for i in missing])
+        for i, pred in zip(missing, preds):
+            if not is_error(pred):
+                self.cache.put(keys[i], pred)
+            results[i] = pred
+        return results
+
+    def infer_stream(self, items: Iterable, batch_size: int = None):
+        """
+        Runs inferences on the incoming images that are not cached yet, yielding the results as they
+        become available. Cached predictions are yielded ahead of the pending batch, i.e., the
+        results are not necessarily in the order of the incoming images. At most a batch of cached
+        predictions gets held back, keeping the memory usage bounded for long runs of cache hits.
+
+        :param items: the (key, image) tuples to run inference on (images are in raw bytes), the keys are passed through
+        :type items: iterable
+        :param batch_size: the number of images per batch, uses Infer.batch_size from the config if None
+        :type batch_size: int
+        :return: the (key, result) tuples
+        """
+        if batch_size is None:
+            batch_size = self.engine.config["Infer"]["batch_size"]
+        items = iter(items)
+        hits = deque()
+        exhausted = False
+
+        def misses():
+            nonlocal exhausted
+            for key, image in items:
+                cache_key = self.cache.key(image)
+                pred = self.cache.get(cache_key)
+                if pred is None:
+                    yield (key, cache_key), image
+                else:
+                    hits.append((key, pred))
+                    if len(hits) >= batch_size:
+                        # ends the stream, the pending batches complete before the hits get yielded
+                        return
+            exhausted = True
+
+        while not exhausted:
+            for (key, cache_key), pred in self.engine.infer_stream(misses(), batch_size=batch_size):
+                while len(hits) > 0:
+                    yield hits.popleft()
+                if not is_error(pred):
+                    self.cache.put(cache_key, pred)
+                yield key, pred
+            while len(hits) > 0:
+                yield hits.popleft()
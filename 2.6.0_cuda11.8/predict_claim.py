@@ -0,0 +1,176 @@
+import os
+import socket
+import threading
+import time
+from typing import List
+
+
+CLAIMS_DIR = ".claims"
+""" the directory within the input directory that holds the claim directories of the workers. """
+
+
+def default_worker_id() -> str:
+    """
+    Generates the default worker ID from host name and process ID.
+
+    :return: the worker ID
+    :rtype: str
+    """
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+class FileClaimer(object):
+    """
+    Claims files in an input directory shared by several pollers (on the same host or on hosts sharing the mount)
+    by renaming them into a claim directory per worker: the rename is atomic, i.e., only one worker can claim a file.
+    The workers keep touching their claim directory while alive, the files in claim directories that have not been
+    touched within the timeout (e.g., of workers that crashed) get moved back into the input directory.
+    """
+
+    def __init__(self, input_dir: str, worker_id: str = None, timeout: float = 300.0):
+        """
+        Initializes the claimer.
+
+        :param input_dir: the input directory the files get claimed from
+        :type input_dir: str
+        :param worker_id: the ID of the worker (name of the claim directory), uses host name and PID if None
+        :type worker_id: str
+        :param timeout: the time in seconds after which the claims of workers that are no longer alive get released
+        :type timeout: float
+        """
+        self.input_dir = input_dir
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.timeout = timeout
+        self.claims_dir = os.path.join(input_dir, CLAIMS_DIR)
+        self.worker_dir = os.path.join(self.claims_dir, self.worker_id)
+        self.claimed = 0
+        self.lost = 0
+        self.released = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _release_dir(self, path: str) -> int:
+        """
+        Moves the files in the claim directory back into the input directory and removes the claim directory.
+
+        :param path: the claim directory
+        :type path: str
+        :return: the number of files moved back
+        :rtype: int
+        """
+        result = 0
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                os.rename(entry.path, os.path.join(self.input_dir, entry.name))
+                result += 1
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        self.released += result
+        return result
+
+    def _run(self):
+        """
+        Touches the claim directory periodically, signalling that the worker is alive.
+        """
+        while not self._stopped.wait(self.timeout / 4):
+            try:
+                os.utime(self.worker_dir)
+            except OSError:
+                os.makedirs(self.worker_dir, exist_ok=True)
+
+    def start(self) -> int:
+        """
+        Creates the claim directory (releasing files left over from a previous run with the same worker ID)
+        and starts signalling that the worker is alive.
+
+        :return: the number of files released from the previous run
+        :rtype: int
+        """
+        result = self._release_dir(self.worker_dir)
+        os.makedirs(self.worker_dir, exist_ok=True)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="file-claimer", daemon=True)
+        self._thread.start()
+        return result
+
+    def release_stale(self) -> int:
+        """
+        Moves the files claimed by workers that are no longer alive back into the input directory.
+
+        :return: the number of files moved back
+        :rtype: int
+        """
+        result = 0
+        now = time.time()
+        with os.scandir(self.claims_dir) as it:
+            entries = [x for x in it if x.is_dir() and (x.path != self.worker_dir)]
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > self.timeout:
+                    result += self._release_dir(entry.path)
+            except FileNotFoundError:
+                pass
+        return result
+
+    def claim(self, max_files: int, extensions: List[str] = None) -> List[str]:
+        """
+        Claims files from the input directory by moving them into the claim directory, until the claim
+        directory holds the maximum number of files. Files claimed by other workers in the meantime get skipped.
+
+        :param max_files: the maximum number of files in the claim directory
+        :type max_files: int
+        :param extensions: the extensions of the files to claim, all files if None
+        :type extensions: list
+        :return: the paths of the newly claimed files
+        :rtype: list
+        """
+        result = []
+        os.makedirs(self.worker_dir, exist_ok=True)
+        with os.scandir(self.worker_dir) as it:
+            num_files = sum(1 for _ in it)
+        if num_files >= max_files:
+            return result
+        with os.scandir(self.input_dir) as it:
+            for entry in it:
+                if num_files + len(result) >= max_files:
+                    break
+                if entry.is_dir():
+                    continue
+                if (extensions is not None) and (os.path.splitext(entry.name)[1] not in extensions):
+                    continue
+                claimed = os.path.join(self.worker_dir, entry.name)
+                try:
+                    os.rename(entry.path, claimed)
+                    result.append(claimed)
+                except FileNotFoundError:
+                    self.lost += 1
+        self.claimed += len(result)
+        return result
+
+    def stats(self) -> str:
+        """
+        Returns the statistics of the claimer.
+
+        :return: the statistics
+        :rtype: str
+        """
+        return "claimed: %d, claimed by others: %d, released: %d" % (self.claimed, self.lost, self.released)
+
+    def close(self):
+        """
+        Stops signalling that the worker is alive and moves unprocessed files back into the input directory.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._release_dir(self.worker_dir)
@@ -1,16 +1,134 @@
 import os
 import argparse
+import threading
 from image_complete import auto
 import traceback
+from typing import List
 
 from sfp import Poller
-from predict_common import prediction_to_file, load_model
+from ppcls.engine.custom_engine import is_error
+from predict_backends import BACKENDS, BACKEND_DYGRAPH, PRECISIONS, PRECISION_FP32
+from predict_cache import PredictionCache, CachedEngine
+from predict_claim import FileClaimer
+from predict_common import prediction_to_file, load_model, report_stats
+from predict_manifest import Manifest, STATUS_FAILED
+from predict_prefetch import Prefetcher
+from predict_sink import SINKS, SINK_FILES, SINK_PARQUET, create_sink
 
 
 SUPPORTED_EXTS = [".jpg", ".jpeg", ".png", ".bmp"]
 """ supported file extensions (lower case). """
 
 
+class PrefetchPoller(Poller):
+    """
+    Poller that reads (and optionally decodes) the files in a thread pool, see Prefetcher: when listing,
+    the files of the listing (limited via max_files) and the window of files following them, i.e., the latter
+    get read while the model runs on the current listing. The completeness check goes through the prefetcher
+    for all candidates, i.e., no file gets read twice.
+    """
+
+    def __init__(self, prefetcher: Prefetcher, window: int):
+        """
+        Initializes the poller.
+
+        :param prefetcher: the prefetcher to use
+        :type prefetcher: Prefetcher
+        :param window: the number of files to prefetch beyond the listing
+        :type window: int
+        """
+        super().__init__()
+        self.prefetcher = prefetcher
+        self.window = window
+
+    def candidates(self) -> List[str]:
+        """
+        Lists the files in the input directory that match the extensions, in directory order.
+
+        :return: the files
+        :rtype: list
+        """
+        result = []
+        with os.scandir(self.input_dir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    continue
+                if (self.extensions is not None) and (os.path.splitext(entry.name)[1] not in self.extensions):
+                    continue
+                result.append(entry.path)
+        return result
+
+    def list_files(self):
+        if not self.is_stopped:
+            try:
+                files = self.candidates()
+                self.prefetcher.retain(files)
+                self.prefetcher.prefetch(files[:max(0, self.max_files) + self.window])
+            except Exception:
+                self.error("Failed to prefetch files!\n%s" % traceback.format_exc())
+        return super().list_files()
+
+
+class ClaimMixin(object):
+    """
+    Mixin for pollers that share the input directory with other pollers (on the same host or on hosts sharing
+    the mount): before listing, files get claimed from the input directory via the FileClaimer and only the
+    files in the claim directory of the poller get listed/processed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.claimer = None
+        self.claim_files = 1
+        self._claim_lock = threading.Lock()
+
+    def list_files(self):
+        with self._claim_lock:
+            if not self.is_stopped:
+                try:
+                    released = self.claimer.release_stale()
+                    if released > 0:
+                        self.info("Released %d file(s) claimed by stale workers" % released)
+                    claimed = self.claimer.claim(self.claim_files, self.extensions)
+                    if len(claimed) > 0:
+                        self.debug("Claimed: %s" % ", ".join(claimed))
+                except Exception:
+                    self.error("Failed to claim files!\n%s" % traceback.format_exc())
+            self.input_dir = self.claimer.worker_dir
+            try:
+                return super().list_files()
+            finally:
+                self.input_dir = self.claimer.input_dir
+
+
+class ClaimingPoller(ClaimMixin, Poller):
+    """
+    Poller that claims the files before processing them, see ClaimMixin.
+    """
+    pass
+
+
+class ClaimingPrefetchPoller(ClaimMixin, PrefetchPoller):
+    """
+    Prefetching poller that claims the files before processing them, see ClaimMixin.
+    """
+    pass
+
+
+def manifest_key(fname: str) -> str:
+    """
+    Generates the key for the manifest from name, size and modification time of the file, i.e., a new file
+    arriving under the same name (e.g., a camera overwriting its snapshot) does not count as processed.
+
+    :param fname: the file to generate the key for
+    :type fname: str
+    :return: the key
+    :rtype: str
+    """
+    stat = os.stat(fname)
+    return "%s|%d|%d" % (os.path.basename(fname), stat.st_size, stat.st_mtime_ns)
+
+
 def check_image(fname, poller):
     """
     Check method that ensures the image is valid.
@@ -22,7 +140,13 @@ def check_image(fname, poller):
     :return: True if complete
     :rtype: bool
     """
-    result = auto.is_image_complete(fname)
+    result = None
+    if poller.params.prefetcher is not None:
+        # candidates not prefetched yet get read via the prefetcher as well, keeping the content for processing
+        poller.params.prefetcher.prefetch([fname])
+        result = poller.params.prefetcher.complete(fname)
+    if result is None:
+        result = auto.is_image_complete(fname)
     poller.debug("Image complete:", fname, "->", result)
     return result
 
@@ -40,28 +164,98 @@ def process_image(fname, output_dir, poller):
     :return: the list of generated output files
     :rtype: list
     """
+    return process_images([fname], output_dir, poller)
+
+
+def process_images(fnames, output_dir, poller):
+    """
+    Method for processing a batch of images, using a single inference call.
+
+    :param fnames: the images to process
+    :type fnames: list
+    :param output_dir: the directory to write the images to
+    :type output_dir: str
+    :param poller: the Poller instance that called the method
+    :type poller: Poller
+    :return: the list of generated output files
+    :rtype: list
+    """
     result = []
 
     try:
-        # TODO batches?
+        engine = poller.params.engine
+        prefetcher = poller.params.prefetcher
+        manifest = poller.params.manifest
+        loaded = []
+        keys = []
         imgs = []
-        with open(fname, "rb") as fp:
-            img_bytes = fp.read()
-            imgs.append(img_bytes)
-        preds = poller.params.engine.infer_raw(imgs)
-        fname_out = os.path.join(output_dir, os.path.splitext(os.path.basename(fname))[0] + ".json")
-        fname_out = prediction_to_file(preds[0], fname_out)
-        result.append(fname_out)
+        for fname in fnames:
+            key = None
+            if manifest is not None:
+                try:
+                    key = manifest_key(fname)
+                except OSError:
+                    poller.error("Failed to determine manifest key: %s\n%s" % (fname, traceback.format_exc()))
+                    continue
+                if manifest.is_processed(key, retry_failed=True):
+                    poller.info("Already processed according to manifest: %s" % fname)
+                    continue
+            try:
+                data = prefetcher.take(fname) if prefetcher is not None else None
+                if data is None:
+                    with open(fname, "rb") as fp:
+                        data = fp.read()
+                imgs.append(data)
+                loaded.append(fname)
+                keys.append(key)
+            except KeyboardInterrupt:
+                raise
+            except:
+                poller.error("Failed to read image: %s\n%s" % (fname, traceback.format_exc()))
+        if len(imgs) == 0:
+            return result
+        preds = engine.infer_raw(imgs)
+        if engine.num_workers > 0:
+            poller.debug("Pipeline stall: %d ms" % int(engine.last_stall_time * 1000))
+        if isinstance(engine, CachedEngine):
+            poller.debug("Cache - %s" % engine.cache.stats())
+        if prefetcher is not None:
+            poller.debug("Prefetch - %s" % prefetcher.stats())
+        if poller.params.reduced_decode_check:
+            poller.info("Reduced decode check: %s" % str(engine.check_reduced_decode(imgs, preds)))
+        for fname, key, pred in zip(loaded, keys, preds):
+            if is_error(pred):
+                poller.error("Failed to process image: %s\n%s" % (fname, pred["error"]))
+                if manifest is not None:
+                    manifest.mark([key], STATUS_FAILED)
+                continue
+            if poller.params.sink is not None:
+                poller.params.sink.write(os.path.basename(fname), pred, manifest_key=key)
+                continue
+            fname_out = os.path.join(output_dir, os.path.splitext(os.path.basename(fname))[0] + ".json")
+            fname_out = prediction_to_file(pred, fname_out, **poller.params.output_options)
+            result.append(fname_out)
+            if manifest is not None:
+                manifest.mark([key])
+        if poller.params.sink is not None:
+            # the inputs get moved/deleted once the batch returns
+            poller.params.sink.flush(sync=True)
+            poller.debug("Sink - %s" % poller.params.sink.stats())
+        if poller.params.claimer is not None:
+            poller.debug("Claims - %s" % poller.params.claimer.stats())
     except KeyboardInterrupt:
         poller.keyboard_interrupt()
     except:
-        poller.error("Failed to process image: %s\n%s" % (fname, traceback.format_exc()))
+        poller.error("Failed to process images: %s\n%s" % (", ".join(fnames), traceback.format_exc()))
     return result
 
 
 def predict_on_images(engine, input_dir, output_dir, tmp_dir,
                       poll_wait=1.0, continuous=False, use_watchdog=False, watchdog_check_interval=10.0,
-                      delete_input=False, verbose=False, quiet=False):
+                      delete_input=False, batch_size=None, output_options=None, reduced_decode_check=False,
+                      prefetch=0, prefetch_threads=4, prefetch_decode=False, sink=None, manifest=None,
+                      claim=False, worker_id=None, claim_files=None, claim_timeout=300.0,
+                      verbose=False, quiet=False):
     """
     Method for performing predictions on images.
 
@@ -83,13 +277,52 @@ def predict_on_images(engine, input_dir, output_dir, tmp_dir,
     :type watchdog_check_interval: float
     :param delete_input: whether to delete the input images rather than moving them to the output directory
     :type delete_input: bool
+    :param batch_size: the number of images to process with a single inference call, uses Infer.batch_size from the config if None
+    :type batch_size: int
+    :param output_options: the keyword arguments for prediction_to_file (top_k, threshold, precision)
+    :type output_options: dict
+    :param reduced_decode_check: whether to compare the predictions against the ones obtained from full-resolution decoding
+    :type reduced_decode_check: bool
+    :param prefetch: the maximum number of files to list per poll (at least the batch size) and to read (and check/decode) ahead in a thread pool, 0 to read the files when processing them
+    :type prefetch: int
+    :param prefetch_threads: the number of threads for prefetching
+    :type prefetch_threads: int
+    :param prefetch_decode: whether to decode the prefetched files as well
+    :type prefetch_decode: bool
+    :param sink: the sink to append the predictions to instead of writing one JSON file per image, None for files
+    :type sink: PredictionSink
+    :param manifest: the manifest for recording the processed images and skipping them (e.g., after a restart), None to disable
+    :type manifest: Manifest
+    :param claim: whether to claim the files before processing them, for sharing the input directory with other pollers
+    :type claim: bool
+    :param worker_id: the ID of the poller for claiming files (name of its claim directory), uses host name and PID if None
+    :type worker_id: str
+    :param claim_files: the maximum number of files to hold claimed at a time, uses the batch size if None
+    :type claim_files: int
+    :param claim_timeout: the time in seconds after which the files claimed by pollers that are no longer alive get released
+    :type claim_timeout: float
     :param verbose: whether to output more logging information
     :type verbose: bool
     :param quiet: whether to suppress output
     :type quiet: bool
     """
 
-    poller = Poller()
+    if batch_size is None:
+        batch_size = engine.config["Infer"]["batch_size"]
+    prefetcher = None
+    claimer = None
+    if prefetch > 0:
+        prefetcher = Prefetcher(prefetch_threads, check=auto.is_image_complete,
+                                decode=engine.decode if prefetch_decode else None)
+        poller = ClaimingPrefetchPoller(prefetcher, prefetch) if claim else PrefetchPoller(prefetcher, prefetch)
+        # bounds the prefetched (i.e., buffered) files to the listing plus the window
+        poller.max_files = max(prefetch, batch_size)
+    else:
+        poller = ClaimingPoller() if claim else Poller()
+    if claim:
+        claimer = FileClaimer(input_dir, worker_id=worker_id, timeout=claim_timeout)
+        poller.claimer = claimer
+        poller.claim_files = claim_files if claim_files is not None else batch_size
     poller.input_dir = input_dir
     poller.output_dir = output_dir
     poller.tmp_dir = tmp_dir
@@ -99,12 +332,34 @@ def predict_on_images(engine, input_dir, output_dir, tmp_dir,
     poller.verbose = verbose
     poller.check_file = check_image
     poller.process_file = process_image
+    poller.process_batch = process_images
+    poller.batch_size = batch_size
     poller.poll_wait = poll_wait
     poller.continuous = continuous
     poller.use_watchdog = use_watchdog
     poller.watchdog_check_interval = watchdog_check_interval
     poller.params.engine = engine
-    poller.poll()
+    poller.params.output_options = output_options if output_options is not None else dict()
+    poller.params.reduced_decode_check = reduced_decode_check
+    poller.params.prefetcher = prefetcher
+    poller.params.sink = sink
+    poller.params.manifest = manifest
+    poller.params.claimer = claimer
+    try:
+        if claimer is not None:
+            released = claimer.start()
+            if released > 0:
+                poller.info("Released %d file(s) claimed by previous run" % released)
+        poller.poll()
+    finally:
+        if claimer is not None:
+            claimer.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        if sink is not None:
+            sink.close()
+        if manifest is not None:
+            manifest.close()
 
 
 if __name__ == '__main__':
@@ -113,6 +368,14 @@ if __name__ == '__main__':
     parser.add_argument('--model_path', help='Path to the trained model (.pdparams file), overrides config file', required=False, default=None)
     parser.add_argument('--class_id_map_file', help='Path to the file with the class index/label mapping, overrides config file', required=False, default=None)
     parser.add_argument('--device', help='The device to use', default="gpu")
+    parser.add_argument('--backend', choices=BACKENDS, help='The backend for running the model; inference/onnx convert the model once (next to the .pdparams file) and use the Paddle Inference predictor/ONNX Runtime', required=False, default=BACKEND_DYGRAPH)
+    parser.add_argument('--precision', choices=PRECISIONS, help='The precision of the model for the inference backend; int8 requires the model generated by paddleclas_quantize', required=False, default=PRECISION_FP32)
+    parser.add_argument('--num_threads', type=int, help='The number of CPU threads for the inference backend (uses all cores if not specified) or the intra-op threads for the onnx backend', required=False, default=None)
+    parser.add_argument('--inter_op_threads', type=int, help='The number of inter-op threads for the onnx backend', required=False, default=None)
+    parser.add_argument('--num_workers', type=int, help='The number of threads for preprocessing the next batch while the model runs on the current one, 0 for serial preprocessing', required=False, default=0)
+    parser.add_argument('--vectorized_preprocess', action='store_true', help='Whether to decode/resize/crop each image into a preallocated batch buffer and normalize the whole batch at once (requires the Infer transforms DecodeImage/ResizeImage/CropImage, NormalizeImage, ToCHWImage)', required=False, default=False)
+    parser.add_argument('--reduced_decode', action='store_true', help='Whether to decode JPEGs at a reduced scale (1/2, 1/4, 1/8) if they are still at least as large as the ResizeImage target', required=False, default=False)
+    parser.add_argument('--reduced_decode_check', action='store_true', help='Whether to also run the images decoded at full resolution through the model and log the agreement with the reduced decoding (for evaluation only, doubles the inference time)', required=False, default=False)
     parser.add_argument('--prediction_in', help='Path to the test images', required=True, default=None)
     parser.add_argument('--prediction_out', help='Path to the output csv files folder', required=True, default=None)
     parser.add_argument('--prediction_tmp', help='Path to the temporary csv files folder', required=False, default=None)
@@ -121,20 +384,76 @@ if __name__ == '__main__':
     parser.add_argument('--use_watchdog', action='store_true', help='Whether to react to file creation events rather than performing fixed-interval polling', required=False, default=False)
     parser.add_argument('--watchdog_check_interval', type=float, help='check interval in seconds for the watchdog', required=False, default=10.0)
     parser.add_argument('--delete_input', action='store_true', help='Whether to delete the input images rather than move them to --prediction_out directory', required=False, default=False)
+    parser.add_argument('--batch_size', type=int, help='The number of polled images to process with a single inference call, uses Infer.batch_size from the config if not specified', required=False, default=None)
+    parser.add_argument('--prefetch', type=int, help='The maximum number of files to list per poll (at least the batch size), which get read in a thread pool, and the number of following files to read while the model runs on the listed ones; the completeness check uses the prefetched content rather than reading the file again; 0 to read the files when processing them', required=False, default=0)
+    parser.add_argument('--prefetch_threads', type=int, help='The number of threads for prefetching', required=False, default=4)
+    parser.add_argument('--prefetch_decode', action='store_true', help='Whether to decode the prefetched images in the thread pool as well', required=False, default=False)
+    parser.add_argument('--output_format', choices=SINKS, help='The format for the predictions; files: one JSON file per image; jsonl/parquet/arrow: appends the predictions to rotating files (one line/row per image)', required=False, default=SINK_FILES)
+    parser.add_argument('--output_prefix', help='The prefix for the names of the rotating files', required=False, default="predictions")
+    parser.add_argument('--output_max_size', type=float, help='The size in MB after which to start a new rotating file, no limit if <= 0', required=False, default=256.0)
+    parser.add_argument('--output_max_age', type=float, help='The time in seconds after which to start a new rotating file, no limit if <= 0', required=False, default=300.0)
+    parser.add_argument('--output_flush_rows', type=int, help='The number of buffered predictions that triggers writing them to the rotating file', required=False, default=1000)
+    parser.add_argument('--output_flush_interval', type=float, help='The maximum time in seconds to buffer predictions before writing them to the rotating file, no limit if <= 0', required=False, default=10.0)
+    parser.add_argument('--manifest', help='The SQLite database for recording the processed images (file name, size, modification time and model fingerprint), for skipping them after a restart; with rotating output files, images only count as processed once their file is complete', required=False, default=None)
+    parser.add_argument('--claim', action='store_true', help='Whether to claim the images (by moving them into a claim directory per poller below --prediction_in) before processing them, for running several pollers on the same input directory (on one host or on hosts sharing the mount) without processing images twice', required=False, default=False)
+    parser.add_argument('--worker_id', help='The ID of the poller for claiming images, must be unique among the pollers; uses host name and PID if not specified (a stable ID allows releasing the images claimed before a restart immediately)', required=False, default=None)
+    parser.add_argument('--claim_files', type=int, help='The maximum number of images to hold claimed at a time, uses the batch size if not specified', required=False, default=None)
+    parser.add_argument('--claim_timeout', type=float, help='The time in seconds after which the images claimed by pollers that are no longer alive (e.g., crashed) get moved back into the input directory', required=False, default=300.0)
+    parser.add_argument('--top_k', type=int, help='The maximum number of classes (highest scores first) to output, all if not specified', required=False, default=None)
+    parser.add_argument('--score_threshold', type=float, help='The minimum score for classes to output, all if not specified', required=False, default=None)
+    parser.add_argument('--score_precision', type=int, help='The number of decimals to round the scores to, no rounding if not specified', required=False, default=None)
+    parser.add_argument('--cache_size', type=int, help='The maximum number of predictions to cache (keyed by a hash of the image bytes), 0 to disable the cache', required=False, default=0)
+    parser.add_argument('--cache_memory', type=float, help='The maximum memory in MB to use for the cached predictions, no limit if not specified', required=False, default=None)
+    parser.add_argument('--collect_stats', action='store_true', help='Whether to record the latencies of the inference stages (decode, preprocessing operators, to_tensor, forward, postprocess) and the batch sizes', required=False, default=False)
+    parser.add_argument('--stats_interval', type=float, help='The interval in seconds for outputting the statistics, only on shutdown if <= 0', required=False, default=60.0)
+    parser.add_argument('--stats_file', help='The JSON file to save the statistics to as well', required=False, default=None)
     parser.add_argument('--verbose', action='store_true', help='Whether to output more logging info', required=False, default=False)
     parser.add_argument('--quiet', action='store_true', help='Whether to suppress output', required=False, default=False)
     parsed = parser.parse_args()
 
     try:
+        if parsed.prefetch_decode and parsed.reduced_decode_check:
+            raise Exception("The reduced decode check (--reduced_decode_check) requires the raw images, cannot be used with --prefetch_decode!")
+        if (parsed.output_format == SINK_PARQUET) and parsed.delete_input:
+            raise Exception("Incomplete Parquet files cannot be recovered after a crash, cannot be used with --delete_input!")
         eng = load_model(parsed.config, model_path=parsed.model_path,
                          class_id_map_file=parsed.class_id_map_file,
+                         num_workers=parsed.num_workers, backend=parsed.backend,
+                         num_threads=parsed.num_threads, inter_op_threads=parsed.inter_op_threads,
+                         precision=parsed.precision, collect_stats=parsed.collect_stats,
+                         vectorized=parsed.vectorized_preprocess, reduced_decode=parsed.reduced_decode,
                          device=parsed.device)
+        if parsed.collect_stats:
+            report_stats(eng, print, interval=parsed.stats_interval, path=parsed.stats_file)
+        if parsed.cache_size > 0:
+            cache_memory = int(parsed.cache_memory * 1024 * 1024) if parsed.cache_memory is not None else None
+            eng = CachedEngine(eng, PredictionCache(eng.fingerprint, max_entries=parsed.cache_size, max_memory=cache_memory))
+
+        output_options = dict(top_k=parsed.top_k, threshold=parsed.score_threshold, precision=parsed.score_precision)
+        manifest = Manifest(parsed.manifest, eng.fingerprint) if parsed.manifest is not None else None
+        sink = create_sink(parsed.output_format, parsed.prediction_out, tmp_dir=parsed.prediction_tmp,
+                           prefix=parsed.output_prefix, max_file_size=int(parsed.output_max_size * 1024 * 1024),
+                           max_file_age=parsed.output_max_age, flush_rows=parsed.output_flush_rows,
+                           flush_interval=parsed.output_flush_interval, output_options=output_options,
+                           on_finalize=manifest.mark if manifest is not None else None)
+        if sink is not None:
+            # rotating files abandoned by a previous run (their images got moved/deleted already)
+            keys = sink.recover()
+            if sink.recovered + sink.discarded > 0:
+                print("Recovered %d predictions from %d abandoned rotating file(s), discarded %d" % (len(keys), sink.recovered, sink.discarded))
 
         # Performing the prediction and producing the predictions files
         predict_on_images(eng, parsed.prediction_in, parsed.prediction_out, parsed.prediction_tmp,
                           continuous=parsed.continuous,
                           use_watchdog=parsed.use_watchdog, watchdog_check_interval=parsed.watchdog_check_interval,
-                          delete_input=parsed.delete_input, verbose=parsed.verbose, quiet=parsed.quiet)
+                          delete_input=parsed.delete_input, batch_size=parsed.batch_size,
+                          reduced_decode_check=parsed.reduced_decode and parsed.reduced_decode_check,
+                          prefetch=parsed.prefetch, prefetch_threads=parsed.prefetch_threads,
+                          prefetch_decode=parsed.prefetch_decode, sink=sink, manifest=manifest,
+                          claim=parsed.claim, worker_id=parsed.worker_id, claim_files=parsed.claim_files,
+                          claim_timeout=parsed.claim_timeout,
+                          output_options=output_options,
+                          verbose=parsed.verbose, quiet=parsed.quiet)
 
     except Exception as e:
         print(traceback.format_exc())
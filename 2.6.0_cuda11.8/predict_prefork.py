@@ -0,0 +1,165 @@
+import gc
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from multiprocessing.connection import wait
+from typing import Callable
+
+from rdh import log
+from predict_batching import OVERFLOW_BLOCK, put_item
+
+
+class WorkerPool(object):
+    """
+    Forks the worker processes once the model has been loaded, so that they share the model's memory
+    copy-on-write, and restarts workers that die. Each worker has its own queue for the items to process,
+    so that a worker dying while reading from its queue cannot block the others.
+    """
+
+    def __init__(self, num_procs: int, target: Callable, restart_delay: float = 1.0, max_queue_size: int = 0,
+                 overflow: str = OVERFLOW_BLOCK):
+        """
+        Initializes the pool.
+
+        :param num_procs: the number of worker processes to fork
+        :type num_procs: int
+        :param target: the function to run in the worker processes, gets called with the index of the worker and its queue
+        :param restart_delay: the time in seconds to wait before restarting a worker that died
+        :type restart_delay: float
+        :param max_queue_size: the maximum number of items in the queue of a worker, unbounded if <= 0
+        :type max_queue_size: int
+        :param overflow: the policy for adding items to a full queue (block/drop_oldest/drop_newest)
+        :type overflow: str
+        """
+        self.num_procs = max(1, num_procs)
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_queue_size = max(0, max_queue_size)
+        self.overflow = overflow
+        self.restarts = 0
+        self.dropped = 0
+        self.stopped = False
+        self._context = multiprocessing.get_context("fork")
+        self._procs = dict()
+        self._queues = dict()
+        self._lock = threading.Lock()
+
+    def _run(self, index: int, items):
+        """
+        Runs the target in the worker process, leaving the handling of signals to the parent.
+
+        :param index: the index of the worker
+        :type index: int
+        :param items: the queue of the worker
+        :type items: multiprocessing.Queue
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.target(index, items)
+
+    def _drain(self, items) -> list:
+        """
+        Removes the items from the queue of a worker that died. Items that cannot be retrieved (e.g., because
+        the worker died while reading from the queue, holding its lock) get counted as dropped.
+
+        :param items: the queue to drain
+        :type items: multiprocessing.Queue
+        :return: the retrieved items
+        :rtype: list
+        """
+        result = []
+        while True:
+            try:
+                result.append(items.get(timeout=0.1))
+            except queue.Empty:
+                break
+        try:
+            lost = items.qsize()
+        except NotImplementedError:
+            lost = 0
+        if lost > 0:
+            log("worker-pool - failed to retrieve %d queued items, dropping them" % lost)
+            self.dropped += lost
+        items.cancel_join_thread()
+        items.close()
+        return result
+
+    def _spawn(self, index: int):
+        """
+        Forks the worker with the specified index. The items still queued for a previous worker
+        with the same index get handed to the new worker.
+
+        :param index: the index of the worker
+        :type index: int
+        """
+        items = self._context.Queue(self.max_queue_size)
+        with self._lock:
+            old = self._queues.get(index)
+            self._queues[index] = items
+        pending = self._drain(old) if old is not None else []
+        proc = self._context.Process(target=self._run, args=(index, items), name="worker-%d" % index, daemon=True)
+        proc.start()
+        with self._lock:
+            self._procs[index] = proc
+        log("worker-pool - started worker #%d: pid %d" % (index, proc.pid))
+        if len(pending) > 0:
+            log("worker-pool - handing %d queued items to worker #%d" % (len(pending), index))
+            for item in pending:
+                self.dropped += put_item(items, item, self.overflow)
+
+    def start(self):
+        """
+        Forks the workers. Objects that exist at this point get moved to the permanent generation of the
+        garbage collector beforehand, to avoid the collector touching (and therefore copying) their pages.
+        """
+        gc.collect()
+        gc.freeze()
+        for index in range(self.num_procs):
+            self._spawn(index)
+
+    def put(self, item):
+        """
+        Hands the item to the live worker with the fewest queued items.
+
+        :param item: the item to process
+        """
+        with self._lock:
+            alive = [index for index, proc in self._procs.items() if proc.is_alive()]
+            if len(alive) == 0:
+                alive = list(self._queues.keys())
+            index = min(alive, key=lambda x: self._queues[x].qsize())
+            items = self._queues[index]
+        self.dropped += put_item(items, item, self.overflow)
+
+    def stop(self, *args):
+        """
+        Terminates the workers.
+        """
+        self.stopped = True
+        for proc in self._procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self._procs.values():
+            proc.join(timeout=10)
+
+    def supervise(self):
+        """
+        Monitors the workers until stopped (SIGTERM/SIGINT), restarting the ones that died.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while not self.stopped:
+                wait([proc.sentinel for proc in self._procs.values()], timeout=1.0)
+                for index, proc in list(self._procs.items()):
+                    if self.stopped or proc.is_alive():
+                        continue
+                    log("worker-pool - worker #%d (pid %d) died with exit code %s, restarting" % (index, proc.pid, str(proc.exitcode)))
+                    time.sleep(self.restart_delay)
+                    self.restarts += 1
+                    self._spawn(index)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip("paddle")
+operators = pytest.importorskip("ppcls.data.preprocess.ops.operators")
+
+from custom_engine import split_preprocess_ops
+
+
+def infer_ops(output_fp16: bool = False):
+    """
+    Creates the Infer transforms of the standard ImageNet configs (without DecodeImage).
+
+    :param output_fp16: whether NormalizeImage outputs float16
+    :type output_fp16: bool
+    :return: the preprocessing operators
+    :rtype: list
+    """
+    return [
+        operators.ResizeImage(resize_short=256),
+        operators.CropImage(size=224),
+        operators.NormalizeImage(scale=1.0 / 255.0, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225],
+                                 order="", output_fp16=output_fp16),
+        operators.ToCHWImage(),
+    ]
+
+
+def test_split_fp32():
+    ops = infer_ops()
+    split = split_preprocess_ops(ops)
+    assert split is not None
+    per_image, normalize, to_chw = split
+    assert per_image == ops[:2]
+    assert normalize is ops[2]
+    assert to_chw
+
+
+def test_split_fp16_falls_back():
+    assert split_preprocess_ops(infer_ops(output_fp16=True)) is None